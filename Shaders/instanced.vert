@@ -0,0 +1,42 @@
+#version 330 core
+
+uniform mat4 model;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
+
+in vec3 tex_coord;
+in vec3 position;
+in vec3 normal;
+
+// per instance: columns of the prop transform (see textures.InstancedProps)
+in vec4 instance_column0;
+in vec4 instance_column1;
+in vec4 instance_column2;
+in vec4 instance_column3;
+
+out vec2 frag_tex_coords;
+
+out vec3 w_position, w_normal;   // in world coordinates
+out vec3 normalized_pos;
+
+void main() {
+    mat4 world = model * mat4(instance_column0, instance_column1, instance_column2, instance_column3);
+
+    // props are scaled non uniformly: normals need the inverse transpose
+    w_normal = mat3(transpose(inverse(world))) * normal;
+    w_position = (world * vec4(position, 1)).xyz;
+
+    vec4 tmp_pos = world * vec4(position, 1);
+    normalized_pos = tmp_pos.xyz / tmp_pos.w;
+
+    gl_Position = projection * view * tmp_pos;
+    frag_tex_coords = tex_coord.xy;
+}
@@ -0,0 +1,32 @@
+#version 330 core
+
+in vec2 frag_tex_coord;
+in vec3 normalized_pos;
+
+uniform sampler2D diffuse_map;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
+
+out vec4 out_color;
+
+void main() {
+    out_color = texture(diffuse_map, frag_tex_coord);
+
+    // particles are not sorted back to front: drop transparent texels
+    if (out_color.a < 0.1)
+        discard;
+
+    float distance = distance(w_camera_position, normalized_pos);
+    out_color = mix( out_color, vec4(skyColour,1), clamp((1 - ((fog_offset - distance) / 50.0)), 0.0, 1.0));
+
+    // Gamma correction
+    out_color.xyz = pow(out_color.xyz, vec3(1.0/gamma));
+}
@@ -0,0 +1,40 @@
+#version 330 core
+
+uniform mat4 model;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
+
+// per vertex: corner of a unit quad centered on the origin
+in vec3 position;
+in vec2 tex_coord;
+
+// per instance: leaf center, fall progress in [0, 1] and size
+in vec3 offset;
+in float phase;
+in float size;
+
+out vec2 frag_tex_coord;
+out vec3 normalized_pos;
+
+void main() {
+    // the leaf spins once around the view axis during its fall
+    float angle = 6.2831853 * phase;
+    vec2 corner = mat2(cos(angle), sin(angle), -sin(angle), cos(angle)) * position.xy * size;
+
+    // billboard: the camera right and up axes are the first rows of view
+    vec3 right = vec3(view[0][0], view[1][0], view[2][0]);
+    vec3 up = vec3(view[0][1], view[1][1], view[2][1]);
+    vec4 tmp_pos = model * vec4(offset, 1);
+    normalized_pos = tmp_pos.xyz / tmp_pos.w + corner.x * right + corner.y * up;
+
+    frag_tex_coord = tex_coord;
+    gl_Position = projection * view * vec4(normalized_pos, 1);
+}
@@ -3,8 +3,6 @@
 // fragment position and normal of the fragment, in WORLD coordinates
 in vec3 w_position, w_normal;
 in vec3 normalized_pos;
-uniform float gamma;
-uniform float fog_offset;
 
 uniform sampler2D diffuse_map;
 in vec2 frag_tex_coords;
@@ -15,9 +13,17 @@ uniform vec3 light_dir;
 // material properties
 uniform vec3 k_a;
 uniform float s;
-// world camera position
-uniform vec3 w_camera_position;
-uniform vec3 skyColour;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
+
 const float density = 0.007;
 
 out vec4 out_color;
@@ -1,8 +1,17 @@
 #version 330 core
 
 uniform mat4 model;
-uniform mat4 view;
-uniform mat4 projection;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
+
 in vec3 tex_coord;
 in vec3 position;
 in vec3 normal;
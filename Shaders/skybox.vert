@@ -3,8 +3,15 @@
 out vec3 frag_tex_coords;
 in vec3 position;
 
-uniform mat4 projection;
-uniform mat4 view;
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
 
 void main()
 {
@@ -5,10 +5,16 @@ in vec3 normalized_pos;
 in float visibility;
 
 uniform sampler2D diffuse_map;
-uniform vec3 skyColour;
-uniform vec3 w_camera_position;
-uniform float gamma;
-uniform float fog_offset;
+
+// per frame data, written once per frame by the viewer (see core.FrameData)
+layout(std140) uniform FrameData {
+    mat4 view;
+    mat4 projection;
+    vec3 w_camera_position;
+    float gamma;
+    vec3 skyColour;
+    float fog_offset;
+};
 
 out vec4 out_color;
 
@@ -1,16 +1,83 @@
 # Python built-in modules
 from bisect import bisect_left      # search sorted keyframe lists
+import weakref                      # unregister animations of dropped nodes
 
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import glfw                         # lean window system wrapper for OpenGL
+import numpy as np                  # batched keyframe evaluation
 
 from core import Node
-from transform import (lerp, quaternion_slerp, quaternion_matrix, identity, translate, scale)
+from transform import (lerp, quaternion_slerp, quaternion_matrix, identity, translate, scale,
+                       trs_matrix)
 
 
 # -------------- Keyframing Utilities ------------------------------------
-class KeyFrames:
+BAKED_TABLES = {}  # (keys, number of samples) -> (table, {mode: error}), shared by tracks
+
+
+class BakedTrack:
+    """ Keyframe track that can be baked into a table of values sampled at a
+        fixed rate, read instead of interpolating keys. Subclasses provide
+        exact(time), exact_at(times), keys() identifying their keys, min_time
+        and max_time """
+    table = None  # baked samples from min_time to max_time, or None
+    mode = 'lerp'  # 'nearest' sample, or 'lerp' between the two around time
+    step = 1.      # time between samples
+    errors = None  # {mode: error bound} of the table, shared with its tracks
+
+    def value(self, time):
+        """ Value at time, from the baked table if any, else exact """
+        return self.exact(time) if self.table is None else self.lookup(time)
+
+    def bake(self, rate=60, mode='lerp', tolerance=None, max_rate=960):
+        """ Bake 'rate' samples per second, read in 'mode'. With a tolerance,
+            the rate is doubled up to max_rate until bake_error is below it """
+        duration = self.max_time - self.min_time
+        while True:
+            samples = max(2, int(np.ceil(duration * rate)) + 1)
+            key = (self.keys(), samples)
+            if key not in BAKED_TABLES:
+                times = np.linspace(self.min_time, self.max_time, samples)
+                BAKED_TABLES[key] = (np.asarray(self.exact_at(times), np.float32), {})
+            self.table, self.errors = BAKED_TABLES[key]
+            self.mode, self.step = mode, duration / (samples - 1) or 1.
+            if tolerance is None or self.bake_error <= tolerance or rate >= max_rate:
+                return
+            rate *= 2
+
+    @property
+    def bake_error(self):
+        """ Error bound of the baked table: the largest difference to exact
+            values, checked at quarters of each step between samples. Computed
+            on first use, once per table and mode """
+        if self.table is None:
+            return 0.
+        if self.mode not in self.errors:
+            checks = np.linspace(self.min_time, self.max_time, 4 * (len(self.table) - 1) + 1)
+            self.errors[self.mode] = float(np.max(np.abs(self.lookup_at(checks) - self.exact_at(checks))))
+        return self.errors[self.mode]
+
+    def lookup(self, time):
+        """ Value at time read from the baked table """
+        position = (min(max(time, self.min_time), self.max_time) - self.min_time) / self.step
+        if self.mode == 'nearest':
+            return self.table[int(round(position))]
+        index = min(int(position), len(self.table) - 2)
+        fraction = position - index
+        return self.table[index] + fraction * (self.table[index + 1] - self.table[index])
+
+    def lookup_at(self, times):
+        """ Values at (T,) times read from the baked table, all at once """
+        position = (np.clip(times, self.min_time, self.max_time) - self.min_time) / self.step
+        if self.mode == 'nearest':
+            return self.table[np.rint(position).astype(int)]
+        index = np.minimum(position.astype(int), len(self.table) - 2)
+        fraction = (position - index).reshape((-1,) + (1,) * (self.table.ndim - 1))
+        return self.table[index] + fraction * (self.table[index + 1] - self.table[index])
+
+
+class KeyFrames(BakedTrack):
     """ Stores keyframe pairs for any value type with interpolation_function"""
     def __init__(self, time_value_pairs, interpolation_function=lerp):
         if isinstance(time_value_pairs, dict):  # convert to list of pairs
@@ -18,8 +85,13 @@ class KeyFrames:
         keyframes = sorted(((key[0], key[1]) for key in time_value_pairs))
         self.times, self.values = zip(*keyframes)  # pairs list -> 2 lists
         self.interpolate = interpolation_function
+        self.min_time, self.max_time = self.times[0], self.times[-1]
 
-    def value(self, time):
+    def keys(self):
+        """ Hashable description of our keys and interpolation """
+        return (self.times, np.array(self.values, np.float64).tobytes(), self.interpolate.__name__)
+
+    def exact(self, time):
         """ Computes interpolated value from keyframes, for a given time """
 
         # 1. ensure time is within bounds else return boundary keyframe
@@ -34,8 +106,18 @@ class KeyFrames:
         # values in self.values, using the stored self.interpolate function
         return self.interpolate(self.values[closest_index-1], self.values[closest_index], fraction)
 
+    def exact_at(self, times):
+        """ Values at (T,) times in one numpy pass, as exact gives them """
+        shape = np.shape(self.values[0])
+        key_times, values, ends = _pack_keys([self], int(np.prod(shape)))
+        count = len(times)
+        before, after, fraction = _sample_keys(np.broadcast_to(key_times, (count, key_times.shape[1])),
+                                               np.broadcast_to(values, (count,) + values.shape[1:]),
+                                               np.broadcast_to(ends, count), times)
+        return self.interpolate(before, after, fraction).reshape((count,) + shape)
+
 
-class TransformKeyFrames:
+class TransformKeyFrames(BakedTrack):
     """ KeyFrames-like object dedicated to 3D transforms """
     def __init__(self, translate_keys, rotate_keys, scale_keys):
         """ stores 3 keyframe sets for translation, rotation, scale """
@@ -46,7 +128,11 @@ class TransformKeyFrames:
         self.min_time = max(self.translation.times[0], max(self.scale.times[0], self.rotation.times[0]))
         self.max_time = min(self.translation.times[-1], min(self.scale.times[-1], self.rotation.times[-1]))
 
-    def value(self, time):
+    def keys(self):
+        """ Hashable description of our keys """
+        return (self.translation.keys(), self.rotation.keys(), self.scale.keys())
+
+    def exact(self, time):
         """ Compute each component's interpolation and compose TRS matrix """
         # 1. ensure time is within bounds else return boundary keyframe
         time = min(max(time, self.min_time), self.max_time)
@@ -57,19 +143,207 @@ class TransformKeyFrames:
         S = scale(self.scale.value(time))
         return T @ R @ S
 
+    def exact_at(self, times):
+        """ (T,4,4) transforms at (T,) times in one numpy pass """
+        return trs_matrix(self.translation.exact_at(times), self.rotation.exact_at(times),
+                          self.scale.exact_at(times))
+
+
+# -------------- Batched evaluation of all animated nodes -----------------
+def _pack_keys(keyframes, size):
+    """ (N,K) times and (N,K,size) values of N KeyFrames, padded to the same
+        number K >= 2 of keys by repeating the last value at later times """
+    count = max(2, max(len(keys.times) for keys in keyframes))
+    times = np.empty((len(keyframes), count))
+    values = np.empty((len(keyframes), count, size))
+    for track, keys in enumerate(keyframes):
+        keys_count = len(keys.times)
+        times[track, :keys_count] = keys.times
+        times[track, keys_count:] = keys.times[-1] + np.arange(1, count - keys_count + 1)
+        values[track, :keys_count] = [np.broadcast_to(value, size) for value in keys.values]
+        values[track, keys_count:] = values[track, keys_count - 1]
+    ends = np.array([keys.times[-1] for keys in keyframes], np.float64)
+    return times, values, ends
+
+
+def _sample_keys(times, values, ends, time):
+    """ Values before and after (N,) times in packed tracks, and fraction
+        between them, as KeyFrames.value does for each track """
+    time = np.clip(time, times[:, 0], ends)
+    after = np.clip(np.count_nonzero(times < time[:, None], axis=1), 1, times.shape[1] - 1)
+    tracks = np.arange(len(times))
+    start, end = times[tracks, after - 1], times[tracks, after]
+    fraction = ((time - start) / (end - start))[:, None]
+    return values[tracks, after - 1], values[tracks, after], fraction
+
+
+def _pad_keys(times, values, count):
+    """ Packed (N,K) times and (N,K,size) values padded to count >= K keys,
+        the way _pack_keys pads shorter tracks """
+    extra = count - times.shape[1]
+    if extra <= 0:
+        return times, values
+    times = np.concatenate((times, times[:, -1:] + np.arange(1, extra + 1)), axis=1)
+    values = np.concatenate((values, np.repeat(values[:, -1:], extra, axis=1)), axis=1)
+    return times, values
+
+
+def _append_rows(group, rows):
+    """ Packed arrays of a group of tracks with rows of new tracks appended """
+    if group is None:
+        return rows
+    for name in ('translation', 'rotation', 'scale'):
+        if name + '_times' in group:
+            count = max(group[name + '_times'].shape[1], rows[name + '_times'].shape[1])
+            for packed in (group, rows):
+                packed[name + '_times'], packed[name + '_values'] = _pad_keys(
+                    packed[name + '_times'], packed[name + '_values'], count)
+    return {name: np.concatenate((group[name], rows[name])) for name in group}
+
+
+class AnimationSystem:
+    """ Registers the TransformKeyFrames of all animated nodes, packed in
+        arrays, and evaluates all of them at once for a given time """
+
+    def __init__(self):
+        self.tracks = []  # (TransformKeyFrames, repeat, time shift) per track, None once unregistered
+        self.free = []  # unregistered track indices, given again by register
+        self.added, self.removed = set(), set()  # tracks to pack or drop on next update
+        self.exact = None  # packed keys of the tracks interpolated from their keys
+        self.baked = None  # packed rows of the tracks read from baked tables
+        self.tables = np.zeros((0, 4, 4), np.float32)  # all distinct baked tables end to end
+        self.table_offsets = {}  # id(table) -> its start in tables; BAKED_TABLES keeps the ids alive
+        self.time = None  # time of the current transforms
+        self.transforms = np.zeros((0, 4, 4), np.float32)
+
+    def register(self, keyframes, repeat=False, shift=0):
+        """ Add a track, returns its index in transforms """
+        if self.free:
+            track = self.free.pop()
+            self.tracks[track] = (keyframes, repeat, shift)
+        else:
+            track = len(self.tracks)
+            self.tracks.append((keyframes, repeat, shift))
+        self.added.add(track)
+        self.time = None
+        return track
+
+    def unregister(self, track):
+        """ Remove a track: its transform is no longer evaluated, and its
+            index may be given to a later track """
+        self.tracks[track] = None
+        self.added.discard(track)
+        self.removed.add(track)
+        self.free.append(track)
+        self.time = None
+
+    def _rows(self, tracks):
+        """ Packed rows of tracks: bounds, repeat, shift, then their keys, or
+            where their rows start in the tables when they are baked """
+        keyframes = [self.tracks[track][0] for track in tracks]
+        rows = dict(track=np.array(tracks, int),
+                    bounds=np.array([[keys.min_time, keys.max_time] for keys in keyframes]),
+                    repeat=np.array([self.tracks[track][1] for track in tracks], bool),
+                    shift=np.array([self.tracks[track][2] for track in tracks], np.float64))
+        if keyframes[0].table is None:
+            for name, size in (('translation', 3), ('rotation', 4), ('scale', 3)):
+                (rows[name + '_times'], rows[name + '_values'],
+                 rows[name + '_ends']) = _pack_keys([getattr(keys, name) for keys in keyframes], size)
+            return rows
+
+        tables, size = [self.tables], len(self.tables)
+        for keys in keyframes:
+            if id(keys.table) not in self.table_offsets:
+                self.table_offsets[id(keys.table)] = size
+                tables.append(keys.table)
+                size += len(keys.table)
+        self.tables = np.concatenate(tables)
+        rows.update(offset=np.array([self.table_offsets[id(keys.table)] for keys in keyframes], int),
+                    samples=np.array([len(keys.table) for keys in keyframes], int),
+                    step=np.array([keys.step for keys in keyframes]),
+                    nearest=np.array([keys.mode == 'nearest' for keys in keyframes], bool))
+        return rows
+
+    def _pack(self):
+        """ Drop the rows of unregistered tracks, and append the rows of the
+            tracks registered since the last update to the packed arrays """
+        if self.removed:
+            removed = np.array(sorted(self.removed), int)
+            for group in (self.exact, self.baked):
+                if group is not None:
+                    kept = ~np.isin(group['track'], removed)
+                    group.update({name: packed[kept] for name, packed in group.items()})
+        added = sorted(self.added)
+        exact = [track for track in added if self.tracks[track][0].table is None]
+        baked = [track for track in added if self.tracks[track][0].table is not None]
+        if exact:
+            self.exact = _append_rows(self.exact, self._rows(exact))
+        if baked:
+            self.baked = _append_rows(self.baked, self._rows(baked))
+        self.added, self.removed = set(), set()
+
+    @staticmethod
+    def _times(group, time):
+        """ Time of each track of a group: shifted, looped or clamped """
+        times = time + group['shift']
+        times = np.where(group['repeat'], times % group['bounds'][:, 1], times)
+        return np.clip(times, group['bounds'][:, 0], group['bounds'][:, 1])
+
+    def update(self, time):
+        """ Transform of every track at time, once per time value """
+        if time == self.time or not self.tracks:
+            return self.transforms
+        if self.added or self.removed:
+            self._pack()
+        transforms = np.empty((len(self.tracks), 4, 4), np.float32)
+
+        exact = self.exact
+        if exact is not None and len(exact['track']):
+            times = self._times(exact, time)
+            t0, t1, fraction = _sample_keys(exact['translation_times'], exact['translation_values'],
+                                            exact['translation_ends'], times)
+            translations = t0 + fraction * (t1 - t0)
+            q0, q1, fraction = _sample_keys(exact['rotation_times'], exact['rotation_values'],
+                                            exact['rotation_ends'], times)
+            quaternions = quaternion_slerp(q0, q1, fraction)
+            s0, s1, fraction = _sample_keys(exact['scale_times'], exact['scale_values'], exact['scale_ends'], times)
+            transforms[exact['track']] = trs_matrix(translations, quaternions, s0 + fraction * (s1 - s0))
+
+        baked = self.baked
+        if baked is not None and len(baked['track']):
+            (offsets, samples, nearest) = (baked['offset'], baked['samples'], baked['nearest'])
+            position = (self._times(baked, time) - baked['bounds'][:, 0]) / baked['step']
+            index = np.where(nearest, np.rint(position), np.minimum(position.astype(int), samples - 2))
+            index = np.minimum(index.astype(int), samples - 1)
+            fraction = np.where(nearest, 0, position - index)[:, None, None]
+            after = offsets + np.minimum(index + 1, samples - 1)
+            before = self.tables[offsets + index]
+            transforms[baked['track']] = before + fraction * (self.tables[after] - before)
+
+        self.transforms, self.time = transforms, time
+        return self.transforms
+
+
+animations = AnimationSystem()  # all KeyFrameControlNodes of the application
+
 
 class KeyFrameControlNode(Node):
     """ Place node with transform keys above a controlled subtree """
+    bake_rate = None  # samples per second to bake looping tracks at, None: exact
+
     def __init__(self, trans_keys, rot_keys, scale_keys, transform=identity(), repeat=False, animationShift=0):
         super().__init__(transform=transform)
         self.repeat = repeat
         self.animationShift = animationShift
         self.keyframes = TransformKeyFrames(trans_keys, rot_keys, scale_keys)
+        if repeat and self.bake_rate:
+            self.keyframes.bake(self.bake_rate)
+        self.track = animations.register(self.keyframes, repeat, animationShift)
+        weakref.finalize(self, animations.unregister, self.track)  # dropped nodes stop being animated
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        """ When redraw requested, interpolate our node transform from keys """
-        if self.repeat :
-            self.transform = self.keyframes.value((glfw.get_time()+self.animationShift)%self.keyframes.max_time)
-        else :
-            self.transform = self.keyframes.value(glfw.get_time()+self.animationShift)
-        super().draw(primitives=primitives, **uniforms)
\ No newline at end of file
+    def draw(self, primitives=GL.GL_TRIANGLES, time=None, **uniforms):
+        """ When redraw requested, read our node transform from the batch of
+            all animated nodes, evaluated once per frame time """
+        time = glfw.get_time() if time is None else time
+        self.transform = animations.update(time)[self.track]
+        super().draw(primitives=primitives, time=time, **uniforms)
\ No newline at end of file
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the CPU side of scene construction and rendering.
+Usage: python benchmark.py [benchmark names...]   (default: run them all)
+"""
+# Python built-in modules
+import glob                 # texture files
+import os                   # page cache eviction
+import random              # seeded lakes
+import sys                  # command line arguments
+import tempfile             # converted textures
+import time                 # high resolution timer
+
+# External, non built-in modules
+import numpy as np          # all matrix manipulations & OpenGL args
+
+import noise
+from animation import AnimationSystem, TransformKeyFrames
+from core import Node
+from particules import ParticleSystem
+from texture import calcNormals, convert_texture, decode_image, decode_images, read_mip_chain
+from textures import Lake, TerrainQuadtree, gridMesh, lodIndex
+from transform import (identity, normalized, quaternion_from_euler, quaternion_matrix, quaternion_mul,
+                       quaternion_slerp, scale, translate, trs_matrix, vec)
+from world import generate_world
+
+BENCHMARKS = {}  # benchmark name -> function, filled by @benchmark
+
+
+def benchmark(function):
+    """ Decorator registering a benchmark function under its own name """
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def best_time(function, *args, repeat=3):
+    """ Best wall time in seconds out of 'repeat' calls of function(*args) """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(name, *timings):
+    """ Print one result line: name then (label, seconds) pairs """
+    cells = ('%s %9.4fs' % (label, seconds) for label, seconds in timings)
+    print('%-28s' % name, ' | '.join(cells))
+
+
+# -------------- normals -------------------------------------------------------
+def calc_normals_loop(vertices, index):
+    """ Reference per-triangle Python loop, as texture.calcNormals used to be """
+    vertices = np.array(vertices, np.float32)
+    index = np.array(index, np.uint32)
+    normals = np.zeros_like(vertices)
+    for k in range(0, index.shape[0], 3):
+        v1, v2, v3 = vertices[index[k]], vertices[index[k+1]], vertices[index[k+2]]
+        tri_normal = np.cross(v2 - v1, v3 - v1)
+        normals[index[k]] += tri_normal
+        normals[index[k+1]] += tri_normal
+        normals[index[k+2]] += tri_normal
+    epsilon = 1e-8
+    normals = np.array([n / np.sqrt(np.sum(n ** 2) + epsilon) for n in normals])
+    return (normals, vertices, index)
+
+
+@benchmark
+def normals():
+    """ calcNormals against the old per-triangle loop """
+    rng = np.random.default_rng(0)
+    for triangles in (10_000, 100_000, 1_000_000):
+        vertices = rng.random((triangles // 2, 3), np.float32)
+        index = rng.integers(0, len(vertices), 3 * triangles, np.uint32)
+        report('normals %d tris' % triangles,
+               ('loop', best_time(calc_normals_loop, vertices, index, repeat=1)),
+               ('area', best_time(calcNormals, vertices, index)),
+               ('angle', best_time(calcNormals, vertices, index, 'angle')))
+
+
+# -------------- procedural terrain -------------------------------------------
+@benchmark
+def grid():
+    """ gridMesh vertices, texture coordinates and index for N x N heightmaps """
+    for size in (256, 1024, 2048):
+        heightmap = np.random.random((size, size))
+        report('grid %dx%d' % (size, size), ('build', best_time(gridMesh, heightmap)))
+
+
+@benchmark
+def lod(chunk_size=32, lod_distance=64):
+    """ Terrain quadtree nodes and triangles drawn around a camera in the
+        middle of the terrain, 10 units high (no frustum culling) """
+    patterns = {}  # lodIndex triangle counts, built once per key
+    for size in (100, 512, 1024, 2048, 4096):
+        positions = gridMesh(np.zeros((size, size)))[0].reshape(size, size, 3)
+        quadtree = TerrainQuadtree(positions, chunk_size)
+        start = time.perf_counter()
+        selection = quadtree.select((0, 10, 0), lod_distance)
+        select = time.perf_counter() - start
+        triangles = nodes = 0
+        for level, (a, b, edges) in enumerate(selection):
+            for n in range(len(a)):
+                rows, columns = quadtree.samples(level, a[n], b[n])
+                key = (len(rows), len(columns), 0, tuple(int(edge) for edge in edges[n]))
+                if key not in patterns:
+                    patterns[key] = len(lodIndex(*key)) // 3
+                triangles += patterns[key]
+            nodes += len(a)
+        report('lod %dx%d' % (size, size), ('select', select))
+        print('%-28s full %d triangles, lod %d triangles, %d nodes drawn of %d tiles, %d patterns'
+              % ('', 2 * (size - 1) ** 2, triangles, nodes, np.prod(quadtree.tiles), len(patterns)))
+
+
+@benchmark
+def heightmaps():
+    """ fbm noise heightmaps, 6 octaves, without and with domain warping,
+        as one piece or as 4 x 4 tiles (the same heights) """
+    for size in (256, 1024, 2048):
+        tile = size // 4
+        report('noise %dx%d' % (size, size), ('fbm', best_time(noise.heightmap, (size, size), repeat=1)),
+               ('warped', best_time(lambda: noise.heightmap((size, size), warp=1.0), repeat=1)),
+               ('16 tiles', best_time(lambda: [noise.heightmap((tile, tile), (i * tile, j * tile))
+                                               for i in range(4) for j in range(4)], repeat=1)))
+
+
+@benchmark
+def lakes(size=2048):
+    """ Lake flood fill from the middle of a size x size terrain, seeded, for
+        growing expansion chances (the terrains use 50) """
+    for expandchance in (50, 65, 70):
+        random.seed(1)
+        start = time.perf_counter()
+        lake = Lake(None, (size, size), None, None, position=(size // 2, size // 2), expandchance=expandchance)
+        report('lake %d%% %dx%d' % (expandchance, size, size), ('grow', time.perf_counter() - start))
+        print('%-28s %d lake cells, %d water vertices' % ('', len(lake.lakeDepths), len(lake.lake)))
+
+
+@benchmark
+def worlds(sizes=(1024, 2048, 4096)):
+    """ Tiled generation of noise worlds (heightmap, lakes, normals, trees),
+        tiles one after the other, then in pools of 2, 4... up to one process
+        per cpu, with the speedup and parallel efficiency of each pool """
+    cpus = os.cpu_count() or 1
+    counts = [1] + [n for n in (2, 4, 8, 16, 32, 64) if n < cpus] + ([cpus] if cpus > 1 else [2])
+    print('%d cpu(s)%s' % (cpus, '' if cpus > 1 else ': pools share one core, speedups are not scaling'))
+    for size in sizes:
+        params = dict(size=(size, size), trees=size * 10, noise=dict(scale=64.0))
+        timings = [(n, best_time(lambda: generate_world(0, n, **params), repeat=1)) for n in counts]
+        serial = timings[0][1]
+        report('world %dx%d' % (size, size), *(('%d worker%s' % (n, 's' * (n > 1)), t) for n, t in timings))
+        print('%-28s' % '  speedup (efficiency)',
+              ' | '.join('%d: %.2fx (%3.0f%%)' % (n, serial / t, 100 * serial / t / n) for n, t in timings[1:]))
+
+
+# -------------- particles -----------------------------------------------------
+@benchmark
+def particles():
+    """ Per frame update of all falling leaves of a ParticleSystem """
+    for count in (1_000, 10_000, 100_000):
+        system = ParticleSystem(shader=None, texture=None)
+        system.emit(np.random.random((count, 3)) * 100, 5, np.random.randint(0, 10, count))
+        report('particles %d leaves' % count, ('update', best_time(system.update, 1.5)))
+
+
+# -------------- transform kernels ---------------------------------------------
+@benchmark
+def transforms(count=100_000, calls=1_000):
+    """ transform.py functions called 'calls' times on single values (N=1),
+        then once on stacks of 'count' vectors or quaternions """
+    rng = np.random.default_rng(0)
+    vectors, factors = rng.random((count, 3), np.float32), rng.random((count, 3), np.float32) + 0.5
+    q0, q1 = (normalized(rng.normal(size=(count, 4)).astype(np.float32)) for _ in range(2))
+    fractions = rng.random(count)
+    for function, args in ((normalized, (vectors,)), (translate, (vectors,)), (scale, (factors,)),
+                           (quaternion_mul, (q0, q1)), (quaternion_matrix, (q0,)),
+                           (quaternion_slerp, (q0, q1, fractions)), (trs_matrix, (vectors, q0, factors))):
+        single = [arg[0] for arg in args]
+        report(function.__name__,
+               ('%d x N=1' % calls, best_time(lambda: [function(*single) for _ in range(calls)])),
+               ('N=%d' % count, best_time(function, *args)))
+
+
+# -------------- scene graph ---------------------------------------------------
+def draw_uncached(node, model):
+    """ Reference traversal, as Node.draw used to be: every product, every frame """
+    node.world_transform = model @ node.transform
+    for child in node.children:
+        draw_uncached(child, node.world_transform)
+
+
+@benchmark
+def scene(nodes=10_000, branching=4):
+    """ One frame of a deep hierarchy of static nodes, then with a moving root """
+    tree = [Node()]  # breadth first: parent of node i is node (i - 1) // branching
+    for i in range(1, nodes):
+        tree.append(Node(transform=translate(1, 0, 0)))
+        tree[(i - 1) // branching].add(tree[i])
+    root, model = tree[0], identity()
+    root.draw(model)  # fill caches
+
+    def moving():
+        root.transform = translate(0, 1, 0)
+        root.draw(model)
+
+    report('scene %d nodes' % nodes, ('uncached', best_time(draw_uncached, root, model)),
+           ('static', best_time(root.draw, model)), ('moving', best_time(moving)))
+
+
+# -------------- animation -----------------------------------------------------
+@benchmark
+def animation():
+    """ Transforms of N looping animated nodes, one by one or all at once,
+        interpolating keys or reading tables baked at 60Hz (100 distinct) """
+    for count in (100, 10_000):
+        system, baked, tracks = AnimationSystem(), AnimationSystem(), []
+        for i in range(count):
+            keyframes = TransformKeyFrames({0: vec(0, 0, 0), 2: vec(i % 100, 1, 0), 4: vec(0, 0, 0)},
+                                           {0: quaternion_from_euler(), 4: quaternion_from_euler(0, 180, 0)},
+                                           {0: 1, 2: 2, 4: 1})
+            tracks.append((keyframes, i % 10 / 10))
+            system.register(keyframes, repeat=True, shift=i % 10 / 10)
+        for keyframes, shift in tracks:
+            keyframes.bake(60)
+            baked.register(keyframes, repeat=True, shift=shift)
+        system.update(0)  # packs the tracks
+        baked.update(0)
+
+        def per_node(time=1.5):
+            return [keys.exact((time + shift) % keys.max_time) for keys, shift in tracks]
+
+        frames = iter(np.linspace(0.1, 3.9, 1000))
+        report('animation %d nodes' % count, ('per node', best_time(per_node)),
+               ('batched', best_time(lambda: system.update(next(frames)))),
+               ('baked', best_time(lambda: baked.update(next(frames)))))
+        print('%-28s baked error %.2g, %d tables'
+              % ('', max(keys.bake_error for keys, _ in tracks), len(set(id(keys.table) for keys, _ in tracks))))
+
+
+# -------------- textures ------------------------------------------------------
+@benchmark
+def decode():
+    """ Decoding all shipped textures and skybox faces, one by one or in parallel """
+    files = sorted(glob.glob('Textures/*.*') + glob.glob('Textures/skybox/*')
+                   + glob.glob('Objects/*/*.jpg') + glob.glob('Objects/*/*.png'))
+    report('decode %d images' % len(files),
+           ('serial', best_time(lambda: [decode_image(file) for file in files])),
+           ('threads', best_time(lambda: list(decode_images(files)))))
+
+
+def drop_cached(*files):
+    """ Asks the OS to forget cached pages of files, for cold load timings """
+    for file in files:
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(file, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+
+@benchmark
+def mips():
+    """ Cold load of source images (decoding, mipmaps made by the GPU) against
+        converted .mip files (memory mapped, every level read once) """
+    with tempfile.TemporaryDirectory() as directory:
+        for name, files in (('flowers.png', ['Textures/flowers.png']),
+                            ('skybox', sorted(glob.glob('Textures/skybox/*.jpg')))):
+            mip_files = [convert_texture(file, mip_file=os.path.join(directory, '%d.mip' % i))
+                         for i, file in enumerate(files)]
+
+            def load_sources():
+                drop_cached(*files)
+                return [decode_image(file).tobytes() for file in files]
+
+            def load_converted():
+                drop_cached(*mip_files)
+                return [level.tobytes() for file, mip_file in zip(files, mip_files)
+                        for level in read_mip_chain(file, mip_file)]
+
+            report('load %s' % name, ('source', best_time(load_sources)),
+                   ('mip', best_time(load_converted)))
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Converts images to pre-mipmapped .mip files, loaded by texture.Texture and the
+skybox without decoding. Each .mip file is written next to its image, and is
+ignored again as soon as the image is modified.
+Usage: python convert_textures.py [--gray] [image files...]   (default: Textures/)
+"""
+# Python built-in modules
+import glob                 # default texture files
+import os                   # file sizes
+import sys                  # command line arguments
+
+from texture import convert_texture
+
+
+def main(args):
+    mode = 'L' if '--gray' in args else 'RGBA'
+    files = [arg for arg in args if arg != '--gray']
+    for tex_file in files or sorted(glob.glob('Textures/*.*') + glob.glob('Textures/skybox/*')):
+        if tex_file.endswith('.mip'):
+            continue
+        mip_file = convert_texture(tex_file, mode)
+        print('%s -> %s (%d KB)' % (tex_file, mip_file, os.path.getsize(mip_file) // 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
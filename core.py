@@ -1,7 +1,11 @@
 # Python built-in modules
 import os  # os function, i.e. checking file status
-from itertools import cycle  # allows easy circular choice list
+import hashlib  # mesh cache file names
+import json  # mesh cache metadata
+from itertools import chain, cycle  # chained iterables, circular choice list
 import atexit  # launch a function at exit
+import time  # load time measurements
+import weakref  # release shared assets with their last node
 
 # External, non built-in modules
 import OpenGL.GL as GL  # standard Python OpenGL wrapper
@@ -12,9 +16,67 @@ import assimpcy  # 3D resource loader
 # our transform functions
 from transform import Trackball, identity
 
-# initialize and automatically terminate glfw on exit
-glfw.init()
-atexit.register(glfw.terminate)
+
+# ------------ per-frame statistics ----------------------------------------
+class FrameStats:
+    """ Named counters accumulated during a frame, rotated by the Viewer """
+
+    def __init__(self):
+        self.counters = {}    # counters of the frame being drawn
+        self.last_frame = {}  # counters of the last complete frame
+
+    def count(self, name, amount=1):
+        """ Add amount to the counter 'name' of the current frame """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def next_frame(self):
+        """ Frame done: keep its counters for reporting, start from zero """
+        self.last_frame, self.counters = self.counters, {}
+
+    def report(self):
+        """ Human readable summary of the last complete frame """
+        return ', '.join('%s: %d' % item for item in sorted(self.last_frame.items()))
+
+
+frame_stats = FrameStats()  # shared by all drawables, see Viewer.run
+
+
+class GLState:
+    """ Remembers the bound program and the last value set to each uniform
+        location, to skip redundant GL calls. All program changes and uniform
+        uploads must go through it, see Shader.set_uniforms and Mesh.draw """
+
+    def __init__(self):
+        self.program = None  # currently bound program
+        self.values = {}     # (program, location) -> last uploaded value
+
+    def use_program(self, program):
+        """ glUseProgram, unless program is already bound """
+        if program == self.program:
+            frame_stats.count('glUseProgram avoided')
+            return
+        GL.glUseProgram(program)
+        self.program = program
+        frame_stats.count('glUseProgram calls')
+
+    def set_uniform(self, program, set_uniform, args, value):
+        """ set_uniform(*args, value) unless the location already holds value """
+        key = (program, args[0])
+        last = self.values.get(key)
+        if last is not None and np.shape(last) == np.shape(value) and np.all(last == value):
+            frame_stats.count('glUniform avoided')
+            return
+        set_uniform(*args, value)
+        self.values[key] = np.array(value)  # copy, value may change in place
+        frame_stats.count('glUniform calls')
+
+    def forget(self, program):
+        """ program is deleted, its glid may be reused """
+        self.values = {key: value for key, value in self.values.items() if key[0] != program}
+        self.program = None if self.program == program else self.program
+
+
+gl_state = GLState()  # single GL context, see Viewer
 
 
 # ------------ low level OpenGL object wrappers ----------------------------
@@ -67,6 +129,8 @@ class Shader:
             name, size, type_ = GL.glGetActiveUniform(self.glid, var)
             name = name.decode().split('[')[0]  # remove array characterization
             args = [GL.glGetUniformLocation(self.glid, name), size]
+            if args[0] == -1:
+                continue  # member of a uniform block, e.g. FrameData
             # add transpose=True as argument for matrix types
             if type_ in {GL.GL_FLOAT_MAT2, GL.GL_FLOAT_MAT3, GL.GL_FLOAT_MAT4}:
                 args.append(True)
@@ -75,14 +139,23 @@ class Shader:
                 print(f'uniform {get_name[type_]} {name}: {call}{tuple(args)}')
             self.uniforms[name] = (self.GL_SETTERS[type_], args)
 
-    def set_uniforms(self, uniforms):
-        """ set only uniform variables that are known to shader """
-        for name in uniforms.keys() & self.uniforms.keys():
-            set_uniform, args = self.uniforms[name]
-            set_uniform(*args, uniforms[name])
+        # per frame uniforms are read from the FrameData buffer, if declared
+        block = GL.glGetUniformBlockIndex(self.glid, 'FrameData')
+        if block != GL.GL_INVALID_INDEX:
+            GL.glUniformBlockBinding(self.glid, block, FrameData.BINDING)
+
+    def set_uniforms(self, uniforms, defaults=None):
+        """ set only uniform variables that are known to shader, from uniforms
+            or else defaults, skipping values already uploaded (see GLState) """
+        defaults = defaults or {}
+        for name, (set_uniform, args) in self.uniforms.items():
+            value = uniforms[name] if name in uniforms else defaults.get(name)
+            if value is not None:
+                gl_state.set_uniform(self.glid, set_uniform, args, value)
 
     def __del__(self):
         GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
+        gl_state.forget(self.glid)
 
     GL_SETTERS = {
         GL.GL_UNSIGNED_INT: GL.glUniform1uiv,
@@ -101,31 +174,71 @@ class Shader:
     }
 
 
+class FrameData:
+    """ Uniform buffer of the std140 FrameData block declared by our shaders:
+        per frame camera, fog and gamma values, uploaded once per frame """
+    BINDING = 0  # uniform buffer binding point of the block
+
+    def __init__(self):
+        # mat4 view, projection; vec3 w_camera_position, float gamma;
+        # vec3 skyColour, float fog_offset: 40 floats, no std140 padding needed
+        self.data = np.zeros(40, np.float32)
+        self.glid = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, self.data.nbytes, None, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, self.BINDING, self.glid)
+        frame_stats.count('GL objects created')
+
+    def update(self, view, projection, w_camera_position, skyColour, gamma, fog_offset):
+        """ Write the values of this frame to the buffer """
+        self.data[0:16] = np.transpose(view).ravel()  # std140 is column major
+        self.data[16:32] = np.transpose(projection).ravel()
+        self.data[32:35], self.data[35] = w_camera_position[:3], gamma
+        self.data[36:39], self.data[39] = skyColour, fog_offset
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
+
+
 class VertexArray:
     """ helper class to create and self destroy OpenGL vertex array objects."""
 
-    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW, instances=None):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex.
+            Optional instances attributes have one row per instance, and the
+            whole array is then drawn once per instance in a single call. """
 
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.glid)
         self.buffers = {}  # we will store buffers in a named dict
-        nb_primitives, size = 0, 0
+        self.nbytes = 0  # GPU memory used by our buffers
+        nb_primitives, nb_instances, size = 0, 0, 0
 
         # load buffer per vertex attribute (in list with index = shader layout)
-        for name, data in attributes.items():
+        # per instance attributes advance once per instance (divisor 1)
+        per_vertex = ((name, data, 0) for name, data in attributes.items())
+        per_instance = ((name, data, 1) for name, data in (instances or {}).items())
+        for name, data, divisor in chain(per_vertex, per_instance):
             loc = GL.glGetAttribLocation(shader.glid, name)
             if loc >= 0:
                 # bind a new vbo, upload its data to GPU, declare size and type
                 self.buffers[name] = GL.glGenBuffers(1)
                 data = np.array(data, np.float32, copy=False)  # ensure format
-                nb_primitives, size = data.shape
+                data = data.reshape(len(data), -1)  # scalars => 1 column
+                if divisor:
+                    nb_instances, size = data.shape
+                else:
+                    nb_primitives, size = data.shape
                 GL.glEnableVertexAttribArray(loc)
                 GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[name])
                 GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
                 GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                self.nbytes += data.nbytes
+                GL.glVertexAttribDivisor(loc, divisor)
 
         # optionally create and upload an index buffer for this object
         self.draw_command = GL.glDrawArrays
@@ -135,11 +248,18 @@ class VertexArray:
             index_buffer = np.array(index, np.int32, copy=False)  # good format
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers['index'])
             GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
+            self.nbytes += index_buffer.nbytes
             self.draw_command = GL.glDrawElements
             self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+        if instances is not None:
+            self.draw_command = (GL.glDrawArraysInstanced if index is None
+                                 else GL.glDrawElementsInstanced)
+            self.arguments += (nb_instances,)
+        frame_stats.count('GL objects created', 1 + len(self.buffers))
 
-    def execute(self, primitive, attributes=None):
-        """ draw a vertex array, either as direct array or indexed array """
+    def execute(self, primitive, attributes=None, index=None):
+        """ draw a vertex array, either as direct array or indexed array,
+            optionally indexed by a shared IndexBuffer instead of our own """
 
         # optionally update the data attribute VBOs, useful for e.g. particles
         attributes = attributes or {}
@@ -148,34 +268,147 @@ class VertexArray:
             GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data)
 
         GL.glBindVertexArray(self.glid)
-        self.draw_command(primitive, *self.arguments)
+        if index is not None:
+            GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, index.glid)
+            GL.glDrawElements(primitive, index.size, GL.GL_UNSIGNED_INT, None)
+        else:
+            self.draw_command(primitive, *self.arguments)
+        frame_stats.count('draw calls')
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
         GL.glDeleteVertexArrays(1, [self.glid])
         GL.glDeleteBuffers(len(self.buffers), list(self.buffers.values()))
 
 
+class IndexBuffer:
+    """ Element array buffer that several vertex arrays can be drawn with """
+
+    def __init__(self, index, usage=GL.GL_STATIC_DRAW):
+        self.glid = GL.glGenBuffers(1)
+        index = np.asarray(index, np.uint32)
+        self.size = index.size
+        GL.glBindVertexArray(0)  # do not steal the index binding of a VAO
+        GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index, usage)
+        frame_stats.count('GL objects created')
+
+    def __del__(self):  # object dies => kill GL buffer from GPU
+        GL.glDeleteBuffers(1, [self.glid])
+
+
 # ------------  Mesh is the core drawable -------------------------------------
 class Mesh:
-    """ Basic mesh class, attributes and uniforms passed as arguments """
+    """ Basic mesh class, attributes and uniforms passed as arguments.
+        An existing vertex_array can be shared instead of uploading attributes.
+        With keep_attributes, the attributes are kept for StaticBatch to merge,
+        and only uploaded if the mesh itself gets drawn """
 
     def __init__(self, shader, attributes, index=None,
-                 usage=GL.GL_STATIC_DRAW, **uniforms):
+                 usage=GL.GL_STATIC_DRAW, instances=None, vertex_array=None,
+                 keep_attributes=False, **uniforms):
         self.shader = shader
         self.uniforms = uniforms
+        self.attributes = attributes if keep_attributes else None  # CPU copy for static batching
+        self.instances = instances
         self.index = index
         self.usage = usage
-        self.vertex_array = VertexArray(shader, attributes, index, usage)
-
-    def draw(self, primitives=GL.GL_TRIANGLES, attributes=None, **uniforms):
-        GL.glUseProgram(self.shader.glid)
-        self.shader.set_uniforms({**self.uniforms, **uniforms})
+        self.vertex_array = vertex_array
+        if vertex_array is None and not keep_attributes:
+            self.vertex_array = VertexArray(shader, attributes, index, usage, instances)
+
+    def draw(self, primitives=GL.GL_TRIANGLES, attributes=None, queue=None, **uniforms):
+        if queue is not None:  # drawn later, see RenderQueue
+            queue.push(self, primitives, dict(uniforms, attributes=attributes))
+            return
+        if self.vertex_array is None:  # kept attributes, first draw
+            self.vertex_array = VertexArray(self.shader, self.attributes, self.index, self.usage, self.instances)
+        gl_state.use_program(self.shader.glid)
+        self.shader.set_uniforms(uniforms, self.uniforms)
         self.vertex_array.execute(primitives, attributes)
     
     def setAttributes(self, attributes):
+        if self.attributes is not None:
+            self.attributes = attributes
         self.vertex_array = VertexArray(self.shader, attributes, self.index, self.usage)
 
 
+class RenderQueue:
+    """ Draw items collected by a scene graph traversal, passing queue=self
+        down Node.draw, then drawn by flush in an order that saves GL state
+        changes: opaque items grouped by depth test, program and textures,
+        then blended items from back to front """
+
+    def __init__(self):
+        self.items = []    # (drawable, primitives, uniforms, textures, blend, depth_func)
+        self.bound = {}    # texture unit -> texture bound during flush
+        self.blend = False
+        self.depth_func = GL.GL_LESS
+
+    def push(self, drawable, primitives, uniforms, textures=(), blend=False,
+             depth_func=GL.GL_LESS):
+        """ drawable.draw(primitives, **uniforms) will be called by flush,
+            with textures bound to units 0, 1..., blending and depth test """
+        self.items.append((drawable, primitives, uniforms, tuple(textures), blend, depth_func))
+
+    def flush(self):
+        """ Draw and forget all queued items """
+        def state_key(item):
+            drawable, _, _, textures, _, depth_func = item
+            shader = getattr(drawable, 'shader', None)
+            return (depth_func != GL.GL_LESS, getattr(shader, 'glid', 0),
+                    tuple(id(texture) for texture in textures))
+
+        def distance(item):
+            uniforms = item[2]
+            model, camera = uniforms.get('model'), uniforms.get('w_camera_position')
+            if model is None or camera is None:
+                return 0
+            return np.linalg.norm(np.asarray(model)[:3, 3] - np.asarray(camera)[:3])
+
+        opaque = sorted((item for item in self.items if not item[4]), key=state_key)
+        blended = sorted((item for item in self.items if item[4]), key=distance, reverse=True)
+        self.bound.clear()  # textures may have been bound since last flush
+        program = None
+        for drawable, primitives, uniforms, textures, blend, depth_func in opaque + blended:
+            shader = getattr(drawable, 'shader', None)
+            if shader is not None and shader is not program:
+                frame_stats.count('program changes')
+                program = shader
+            self._bind(textures)
+            self._set_blend(blend)
+            self._set_depth_func(depth_func)
+            drawable.draw(primitives=primitives, **uniforms)
+        self._set_blend(False)
+        self._set_depth_func(GL.GL_LESS)
+        frame_stats.count('draw items', len(self.items))
+        self.items.clear()
+
+    def _bind(self, textures):
+        for unit, texture in enumerate(textures):
+            glid = texture.glid  # marks cached textures as used
+            if self.bound.get(unit) != (texture.type, glid):
+                GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+                GL.glBindTexture(texture.type, glid)
+                self.bound[unit] = (texture.type, glid)
+                frame_stats.count('texture changes')
+
+    def _set_blend(self, blend):
+        if blend != self.blend:
+            if blend:
+                GL.glEnable(GL.GL_BLEND)
+                GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+            else:
+                GL.glDisable(GL.GL_BLEND)
+            self.blend = blend
+            frame_stats.count('blend changes')
+
+    def _set_depth_func(self, depth_func):
+        if depth_func != self.depth_func:
+            GL.glDepthFunc(depth_func)
+            self.depth_func = depth_func
+            frame_stats.count('depth test changes')
+
+
 # ------------  Node is the core drawable for hierarchical scene graphs -------
 class Node:
     """ Scene graph transform and parameter broadcast node """
@@ -183,8 +416,20 @@ class Node:
     def __init__(self, children=(), transform=identity()):
         self.transform = transform
         self.world_transform = identity()
+        self.parent_model = None  # model the world_transform was computed from
         self.children = list(iter(children))
 
+    @property
+    def transform(self):
+        """ Local transform. Assign a new matrix to change it: modifying it
+            in place would not update the cached world transforms """
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        self._transform = transform
+        self.dirty = True
+
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
@@ -193,11 +438,32 @@ class Node:
         for drawable in drawables :
             self.children.remove(drawable)
 
+    def update(self, model=identity()):
+        """ World transform under parent's model matrix, recomputed only when
+            our transform was set or the parent's world transform changed:
+            unchanged matrices are passed down as the same object """
+        if self.dirty or model is not self.parent_model:
+            self.world_transform = model @ self._transform
+            self.parent_model = model
+            self.dirty = False
+        return self.world_transform
+
     def draw(self, model=identity(), **other_uniforms):
         """ Recursive draw, passing down updated model matrix. """
-        self.world_transform = model @ self.transform
+        world_transform = self.update(model)
+        for child in self.children:
+            child.draw(model=world_transform, **other_uniforms)
+
+    def traverse(self, model=identity()):
+        """ Depth first (drawable, world transform) pairs of this subtree,
+            updating world transforms without drawing, e.g. for picking """
+        world_transform = self.update(model)
+        yield self, world_transform
         for child in self.children:
-            child.draw(model=self.world_transform, **other_uniforms)
+            if isinstance(child, Node):
+                yield from child.traverse(world_transform)
+            else:
+                yield child, world_transform
 
     def key_handler(self, key):
         """ Dispatch keyboard events to children with key handler """
@@ -210,9 +476,9 @@ MAX_BONES = 128
 
 # optionally load texture module
 try:
-    from texture import Texture, Textured
+    from texture import Texture, Textured, texture_cache
 except ImportError:
-    Texture, Textured = None, None
+    Texture, Textured, texture_cache = None, None, None
 
 
 # optionally load animation module
@@ -222,133 +488,319 @@ except ImportError:
     KeyFrameControlNode, Skinned = None, None
 
 
-def load(file, shader, tex_file=None, **params):
-    """ load resources from file using assimp, return node hierarchy """
+# assimp post processing applied to every loaded file, part of the cache key
+ASSIMP_FLAGS = ('aiProcess_JoinIdenticalVertices', 'aiProcess_FlipUVs',
+                'aiProcess_OptimizeMeshes', 'aiProcess_Triangulate',
+                'aiProcess_GenSmoothNormals', 'aiProcess_ImproveCacheLocality',
+                'aiProcess_RemoveRedundantMaterials')
+
+# processed scenes are cached there, see load_scene
+MESH_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '.cache', 'meshes')
+
+# material properties kept from assimp, all that load uses
+MATERIAL_PROPERTIES = ('COLOR_DIFFUSE', 'COLOR_SPECULAR', 'COLOR_AMBIENT',
+                       'SHININESS', 'TEXTURE_BASE')
+
+
+def import_scene(file, flags=ASSIMP_FLAGS):
+    """ Import file with assimp into a plain scene description: numpy arrays
+        per mesh, materials, node hierarchy and first animation keys """
     try:
         pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
-        flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
-        flags |= pp.aiProcess_GenSmoothNormals
-        flags |= pp.aiProcess_ImproveCacheLocality
-        flags |= pp.aiProcess_RemoveRedundantMaterials
-        scene = assimpcy.aiImportFile(file, flags)
+        scene = assimpcy.aiImportFile(file, sum(getattr(pp, f) for f in flags))
     except assimpcy.all.AssimpError as exception:
         print('ERROR loading', file + ': ', exception.args[0].decode())
-        return []
+        return None
 
-    # ----- Pre-load textures; embedded textures not supported at the moment
-    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
-    for mat in scene.mMaterials:
-        if tex_file:
-            tfile = tex_file
-        elif 'TEXTURE_BASE' in mat.properties:  # texture token
-            name = mat.properties['TEXTURE_BASE'].split('/')[-1].split('\\')[-1]
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            tfile = next((os.path.join(d, f) for d, _, n in paths for f in n
-                          if name.startswith(f) or f.startswith(name)), None)
-            assert tfile, 'Cannot find texture %s in %s subtree' % (name, path)
-        else:
-            tfile = None
-        if Texture is not None and tfile:
-            mat.properties['diffuse_map'] = Texture(tex_file=tfile)
+    def to_list(value):  # assimp values => json friendly values
+        return value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+
+    materials = [{k: to_list(v) for k, v in mat.properties.items()
+                  if k in MATERIAL_PROPERTIES} for mat in scene.mMaterials]
 
     # ----- load animations
     def conv(assimp_keys, ticks_per_second):
-        """ Conversion from assimp key struct to our dict representation """
-        return {key.mTime / ticks_per_second: key.mValue for key in assimp_keys}
+        """ Conversion from assimp key struct to (time, value) pairs """
+        return [(float(key.mTime / ticks_per_second), to_list(key.mValue))
+                for key in assimp_keys]
 
     # load first animation in scene file (could be a loop over all animations)
-    transform_keyframes = {}
+    animations = {}
     if scene.HasAnimations:
         anim = scene.mAnimations[0]
         for channel in anim.mChannels:
-            # for each animation bone, store TRS dict with {times: transforms}
-            transform_keyframes[channel.mNodeName] = (
+            # for each animation bone, store TRS keys as (time, value) pairs
+            animations[channel.mNodeName] = (
                 conv(channel.mPositionKeys, anim.mTicksPerSecond),
                 conv(channel.mRotationKeys, anim.mTicksPerSecond),
                 conv(channel.mScalingKeys, anim.mTicksPerSecond)
             )
 
+    def make_node(assimp_node):
+        """ Recursively describe assimp nodes """
+        return dict(name=assimp_node.mName,
+                    transform=to_list(assimp_node.mTransformation),
+                    meshes=[int(i) for i in assimp_node.mMeshes],
+                    children=[make_node(c) for c in assimp_node.mChildren])
+
+    meshes = []
+    for mesh in scene.mMeshes:
+        attributes = dict(position=mesh.mVertices, normal=mesh.mNormals)
+        if mesh.HasTextureCoords[0]:
+            attributes.update(tex_coord=mesh.mTextureCoords[0])
+        if mesh.HasVertexColors[0]:
+            attributes.update(color=mesh.mColors[0])
+
+        # skinned mesh: weights given per bone => convert per vertex for GPU
+        # keeping the 4 highest weights of each vertex, high weights last
+        bones = mesh.mBones[:MAX_BONES] if mesh.HasBones else []
+        if bones:
+            weights = np.zeros((mesh.mNumVertices, len(bones)), np.float32)
+            for bone_id, bone in enumerate(bones):
+                for entry in bone.mWeights:
+                    weights[entry.mVertexId, bone_id] = entry.mWeight
+            ids = np.argsort(weights, axis=1, kind='stable')[:, -4:]
+            weights = np.take_along_axis(weights, ids, axis=1)
+            ids[weights == 0] = 0
+            padding = ((0, 0), (4 - weights.shape[1], 0))  # less than 4 bones
+            attributes.update(bone_ids=np.pad(ids, padding).astype(np.uint32),
+                              bone_weights=np.pad(weights, padding))
+
+        meshes.append(dict(
+            attributes={k: np.asarray(v, np.float32 if k != 'bone_ids' else np.uint32)
+                        for k, v in attributes.items()},
+            index=np.asarray(mesh.mFaces, np.uint32),
+            material=int(mesh.mMaterialIndex),
+            bones=[(bone.mName, to_list(bone.mOffsetMatrix)) for bone in mesh.mBones]
+            if mesh.HasBones else []))
+
+    return dict(meshes=meshes, materials=materials, animations=animations,
+                root=make_node(scene.mRootNode),
+                nb_animations=int(scene.mNumAnimations))
+
+
+def _cache_paths(file, flags):
+    """ Cache file prefix of file, and cache file name of its current state """
+    path = os.path.abspath(file)
+    status = os.stat(path)
+    prefix = hashlib.sha1(path.encode()).hexdigest()[:16]
+    key = repr((path, status.st_mtime_ns, status.st_size, tuple(flags)))
+    name = '%s-%s.npz' % (prefix, hashlib.sha1(key.encode()).hexdigest()[:16])
+    return prefix, os.path.join(MESH_CACHE_DIR, name)
+
+
+def _save_scene(scene, cache_file):
+    """ Write scene description as uncompressed npz: arrays + json metadata """
+    arrays = {}
+    meta = dict(scene, meshes=[])
+    for i, mesh in enumerate(scene['meshes']):
+        for name, data in mesh['attributes'].items():
+            arrays['mesh%d_%s' % (i, name)] = data
+        arrays['mesh%d_index' % i] = mesh['index']
+        meta['meshes'].append(dict(attributes=list(mesh['attributes']),
+                                   material=mesh['material'],
+                                   bones=mesh['bones']))
+    os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+    temporary = cache_file + '.%d.tmp' % os.getpid()
+    with open(temporary, 'wb') as file:
+        np.savez(file, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(temporary, cache_file)  # atomic, never a half written cache
+
+
+def _read_scene(cache_file):
+    """ Read back a scene description written by _save_scene """
+    with np.load(cache_file) as data:
+        scene = json.loads(str(data['meta']))
+        for i, mesh in enumerate(scene['meshes']):
+            mesh['attributes'] = {name: data['mesh%d_%s' % (i, name)]
+                                  for name in mesh['attributes']}
+            mesh['index'] = data['mesh%d_index' % i]
+    return scene
+
+
+def load_scene(file, flags=ASSIMP_FLAGS, use_cache=True):
+    """ Scene description of file, from the on-disk cache when it is up to
+        date (same path, modification time, size and flags), else imported
+        with assimp and written to the cache for the next start """
+    if use_cache and not os.path.isfile(file):
+        use_cache = False  # nothing to cache, assimp reports the error
+    cache_file = _cache_paths(file, flags)[1] if use_cache else None
+    if use_cache and os.path.exists(cache_file):
+        try:
+            return _read_scene(cache_file)
+        except (OSError, ValueError, KeyError) as exception:
+            print('WARNING: ignoring broken cache', cache_file, exception)
+    scene = import_scene(file, flags)
+    if use_cache and scene is not None:
+        invalidate_mesh_cache(file)  # drop entries of older file versions
+        _save_scene(scene, cache_file)
+    return scene
+
+
+def invalidate_mesh_cache(file=None):
+    """ Remove cached scenes of file, or the whole mesh cache if None """
+    if not os.path.isdir(MESH_CACHE_DIR):
+        return
+    prefix = None
+    if file is not None:
+        path = os.path.abspath(file)
+        prefix = hashlib.sha1(path.encode()).hexdigest()[:16] + '-'
+    for name in os.listdir(MESH_CACHE_DIR):
+        if prefix is None or name.startswith(prefix):
+            os.remove(os.path.join(MESH_CACHE_DIR, name))
+
+
+def prewarm_mesh_cache(*files, flags=ASSIMP_FLAGS):
+    """ Import files now so that the next load_scene calls hit the cache """
+    for file in files:
+        load_scene(file, flags)
+
+
+def load(file, shader, tex_file=None, assets=None, **params):
+    """ load resources from file using assimp, return node hierarchy.
+        assets: optional dict reused across calls to share the scene
+        description, vertex arrays and textures, see AssetRegistry """
+    assets = {} if assets is None else assets
+    scene = assets['scene'] = assets.get('scene') or load_scene(file)
+    if scene is None:
+        return []
+    textures = assets.setdefault('textures', {})  # material id -> Texture
+    vertex_arrays = assets.setdefault('vertex_arrays', {})  # mesh id -> VAO
+
+    # ----- Pre-load textures; embedded textures not supported at the moment
+    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
+    for mat_id, mat in enumerate(scene['materials']):
+        if mat_id in textures:
+            continue
+        if tex_file:
+            tfile = tex_file
+        elif 'TEXTURE_BASE' in mat:  # texture token
+            name = mat['TEXTURE_BASE'].split('/')[-1].split('\\')[-1]
+            # search texture in file's whole subdir since path often screwed up
+            paths = os.walk(path, followlinks=True)
+            tfile = next((os.path.join(d, f) for d, _, n in paths for f in n
+                          if name.startswith(f) or f.startswith(name)), None)
+            assert tfile, 'Cannot find texture %s in %s subtree' % (name, path)
+        else:
+            tfile = None
+        if texture_cache is not None and tfile:
+            textures[mat_id] = texture_cache.get(tfile)
+
     # ---- prepare scene graph nodes
     nodes = {}  # nodes name -> node lookup
-    nodes_per_mesh_id = [[] for _ in scene.mMeshes]  # nodes holding a mesh_id
+    nodes_per_mesh_id = [[] for _ in scene['meshes']]  # nodes holding a mesh_id
 
-    def make_nodes(assimp_node):
-        """ Recursively builds nodes for our graph, matching assimp nodes """
-        keyframes = transform_keyframes.get(assimp_node.mName, None)
+    def make_nodes(description):
+        """ Recursively builds nodes for our graph, matching scene nodes """
+        keyframes = scene['animations'].get(description['name'], None)
+        transform = np.array(description['transform'], np.float32)
         if keyframes and KeyFrameControlNode:
-            node = KeyFrameControlNode(*keyframes, assimp_node.mTransformation)
+            keyframes = [[(time, np.array(value, np.float32)) for time, value in keys]
+                         for keys in keyframes]
+            node = KeyFrameControlNode(*keyframes, transform)
         else:
-            node = Node(transform=assimp_node.mTransformation)
-        nodes[assimp_node.mName] = node
-        for mesh_index in assimp_node.mMeshes:
+            node = Node(transform=transform)
+        nodes[description['name']] = node
+        for mesh_index in description['meshes']:
             nodes_per_mesh_id[mesh_index] += [node]
-        node.add(*(make_nodes(child) for child in assimp_node.mChildren))
+        node.add(*(make_nodes(child) for child in description['children']))
         return node
 
-    root_node = make_nodes(scene.mRootNode)
+    root_node = make_nodes(scene['root'])
 
     # ---- create optionally decorated (Skinned, Textured) Mesh objects
-    for mesh_id, mesh in enumerate(scene.mMeshes):
+    for mesh_id, mesh in enumerate(scene['meshes']):
         # retrieve materials associated to this mesh
-        mat = scene.mMaterials[mesh.mMaterialIndex].properties
+        mat = scene['materials'][mesh['material']]
 
         # initialize mesh with args from file, merge and override with params
-        index = mesh.mFaces
         uniforms = dict(
             k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
             k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
             k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
             s=mat.get('SHININESS', 16.),
         )
-        attributes = dict(
-            position=mesh.mVertices,
-            normal=mesh.mNormals,
-        )
-
-        # ---- optionally add texture coordinates attribute if present
-        if mesh.HasTextureCoords[0]:
-            attributes.update(tex_coord=mesh.mTextureCoords[0])
-
-        # --- optionally add vertex colors as attributes if present
-        if mesh.HasVertexColors[0]:
-            attributes.update(color=mesh.mColors[0])
-
-        # ---- compute and add optional skinning vertex attributes
-        if mesh.HasBones:
-            # skinned mesh: weights given per bone => convert per vertex for GPU
-            # first, populate an array with MAX_BONES entries per vertex
-            vbone = np.array([[(0, 0)] * MAX_BONES] * mesh.mNumVertices,
-                             dtype=[('weight', 'f4'), ('id', 'u4')])
-            for bone_id, bone in enumerate(mesh.mBones[:MAX_BONES]):
-                for entry in bone.mWeights:  # need weight,id pairs for sorting
-                    vbone[entry.mVertexId][bone_id] = (entry.mWeight, bone_id)
-
-            vbone.sort(order='weight')  # sort rows, high weights last
-            vbone = vbone[:, -4:]  # limit bone size, keep highest 4
-
-            attributes.update(bone_ids=vbone['id'],
-                              bone_weights=vbone['weight'])
-
-        new_mesh = Mesh(shader, attributes, index, **{**uniforms, **params})
-
-        if Textured is not None and 'diffuse_map' in mat:
-            new_mesh = Textured(new_mesh, diffuse_map=mat['diffuse_map'])
-        if Skinned and mesh.HasBones:
+        new_mesh = Mesh(shader, mesh['attributes'], mesh['index'],
+                        vertex_array=vertex_arrays.get(mesh_id),
+                        **{**uniforms, **params})
+        vertex_arrays[mesh_id] = new_mesh.vertex_array
+
+        if Textured is not None and mesh['material'] in textures:
+            new_mesh = Textured(new_mesh, diffuse_map=textures[mesh['material']])
+        if Skinned and mesh['bones']:
             # make bone lookup array & offset matrix, indexed by bone index (id)
-            bone_nodes = [nodes[bone.mName] for bone in mesh.mBones]
-            bone_offsets = [bone.mOffsetMatrix for bone in mesh.mBones]
+            bone_nodes = [nodes[name] for name, _ in mesh['bones']]
+            bone_offsets = [np.array(offset, np.float32) for _, offset in mesh['bones']]
             new_mesh = Skinned(new_mesh, bone_nodes, bone_offsets)
         for node_to_populate in nodes_per_mesh_id[mesh_id]:
             node_to_populate.add(new_mesh)
 
-    nb_triangles = sum((mesh.mNumFaces for mesh in scene.mMeshes))
+    nb_triangles = sum((len(mesh['index']) for mesh in scene['meshes']))
     print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations)' %
-          (scene.mNumMeshes, nb_triangles, len(nodes), scene.mNumAnimations))
+          (len(scene['meshes']), nb_triangles, len(nodes), scene['nb_animations']))
     return [root_node]
 
 
+class AssetRegistry:
+    """ Loads each (file, shader, tex_file) once: later loads return a new
+        node hierarchy sharing the same vertex arrays and textures. Assets
+        are reference counted, one reference per returned node, released when
+        that node is garbage collected: they are dropped with the last one """
+
+    def __init__(self):
+        self.assets = {}  # (path, shader, tex_file) -> shared load() assets
+        self.stats = {}   # (path, shader, tex_file) -> counters, see report
+
+    def load(self, file, shader, tex_file=None, **params):
+        """ Same as core.load, but sharing GPU resources between instances """
+        key = (os.path.abspath(file), shader, tex_file)
+        assets = self.assets.setdefault(key, dict(references=0))
+        stats = self.stats.setdefault(key, dict(imports=0, instances=0, gpu_bytes=0,
+                                                import_seconds=0., instance_seconds=0.))
+        imported = assets.get('scene') is not None
+        start = time.perf_counter()
+        nodes = load(file, shader, tex_file, assets=assets, **params)
+        elapsed = time.perf_counter() - start
+        assets['references'] += len(nodes)
+        for node in nodes:  # shared GL objects live as long as nodes use them
+            weakref.finalize(node, self.release, file, shader, tex_file)
+        stats['instances'] += 1
+        if imported:
+            stats['instance_seconds'] += elapsed
+        else:
+            stats['imports'] += 1
+            stats['import_seconds'] += elapsed
+            stats['gpu_bytes'] = sum(vertex_array.nbytes for vertex_array
+                                     in assets.get('vertex_arrays', {}).values())
+        return nodes
+
+    def release(self, file, shader, tex_file=None):
+        """ One user of these assets is done, forget them after the last one.
+            Unknown or already dropped assets are ignored """
+        key = (os.path.abspath(file), shader, tex_file)
+        assets = self.assets.get(key)
+        if assets is None:
+            return
+        assets['references'] -= 1
+        if assets['references'] <= 0:
+            del self.assets[key]  # GL objects die with the last node using them
+
+    def report(self):
+        """ Human readable memory and load time summary of each asset """
+        lines = []
+        for (path, _, tex_file), stats in self.stats.items():
+            lines.append('%s: %d instances, %d imports, %.1f KB of vertex arrays shared, '
+                         '%.3fs to import, %.3fs for other instances'
+                         % (os.path.relpath(path), stats['instances'], stats['imports'],
+                            stats['gpu_bytes'] / 1024, stats['import_seconds'],
+                            stats['instance_seconds']))
+        return '\n'.join(lines)
+
+
+assets = AssetRegistry()  # shared by the whole application
+
+
 # ------------  Viewer class & window management ------------------------------
 class Viewer(Node):
     """ GLFW viewer window, with classic initialization & graphics loop """
@@ -356,6 +808,11 @@ class Viewer(Node):
     def __init__(self, width=640, height=480):
         super().__init__()
 
+        # initialize glfw with the window rather than on import, so processes
+        # importing this module (world generation workers) stay headless
+        glfw.init()
+        atexit.register(glfw.terminate)  # automatically terminate on exit
+
         # version hints: create GL window with >= OpenGL 3.3 and core profile
         glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
         glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
@@ -373,6 +830,7 @@ class Viewer(Node):
 
         self.gamma = 1
         self.fog_offset = 150
+        self.sky_colour = (115/256, 149/256, 153/256)
 
         # register event handlers
         glfw.set_key_callback(self.win, self.on_key)
@@ -393,26 +851,40 @@ class Viewer(Node):
         # cyclic iterator to easily toggle polygon rendering modes
         self.fill_modes = cycle([GL.GL_LINE, GL.GL_POINT, GL.GL_FILL])
 
+        # per frame uniforms shared by all shaders
+        self.frame_data = FrameData()
+
+        # scene is traversed first, then drawn sorted by GL state; set to
+        # None to draw each drawable as soon as it is traversed
+        self.render_queue = RenderQueue()
+
     def run(self):
         """ Main render loop for this OpenGL window """
+        root_model = identity()
         while not glfw.window_should_close(self.win):
             # clear draw buffer and depth buffer (<-TP2)
             GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
 
             win_size = glfw.get_window_size(self.win)
 
-            # draw our scene objects
-            cam_pos = np.linalg.inv(self.trackball.view_matrix())[:, 3]
-            self.draw(view=self.trackball.view_matrix(),
-                      projection=self.trackball.projection_matrix(win_size),
-                      model=identity(),
-                      w_camera_position=cam_pos,
-                      skyColour=(115/256, 149/256, 153/256),
-                      gamma=self.gamma,
-                      fog_offset=self.fog_offset)
+            # per frame uniforms go to the FrameData buffer once; they are
+            # still passed down for CPU side culling and level of detail
+            frame = dict(view=self.trackball.view_matrix(),
+                         projection=self.trackball.projection_matrix(win_size),
+                         skyColour=self.sky_colour, gamma=self.gamma,
+                         fog_offset=self.fog_offset)
+            frame['w_camera_position'] = np.linalg.inv(frame['view'])[:, 3]
+            self.frame_data.update(**frame)
+
+            # draw our scene objects, from the same root model matrix every
+            # frame so that static nodes keep their cached world transforms
+            self.draw(model=root_model, queue=self.render_queue, time=glfw.get_time(), **frame)
+            if self.render_queue is not None:
+                self.render_queue.flush()
 
             # flush render commands, and swap draw buffers
             glfw.swap_buffers(self.win)
+            frame_stats.next_frame()
 
             # Poll for and process events
             glfw.poll_events()
@@ -446,6 +918,11 @@ class Viewer(Node):
                 self.fog_offset += 3
             if key == glfw.KEY_L:
                 self.fog_offset -= 3
+            if key == glfw.KEY_I:
+                print(frame_stats.report())
+                print(assets.report())
+                if texture_cache is not None:
+                    print(texture_cache.report())
 
             # call Node.key_handler which calls key_handlers for all drawables
             self.key_handler(key)
@@ -0,0 +1,97 @@
+"""
+Mesh geometry computed with numpy only, no OpenGL: heightmap grids, smooth
+normals, water masks and tree placement. world generation jobs import it in
+their worker processes, which must not load the GL stack (see world.TilePool).
+"""
+# External, non built-in modules
+import numpy as np          # all geometry arrays
+
+
+def gridMesh(heightmap, height_scale=1, position=(0, 0, 0), origin=(0, 0), shape=None):
+    """ Vertices, texture coordinates and uint32 triangle index of a grid mesh
+        lifted by an (x, y) heightmap, built with numpy broadcasting only.
+        heightmap may be the block at vertex origin of a grid of a larger
+        shape: vertices are then those of the block in the whole grid """
+    heightmap = np.asarray(heightmap, np.float32)
+    (x, y) = heightmap.shape
+    (X, Y) = heightmap.shape if shape is None else shape
+    (px, pz, py) = position
+    i, j = np.arange(origin[0], origin[0] + x), np.arange(origin[1], origin[1] + y)
+
+    vertices = np.empty((x, y, 3), np.float32)
+    vertices[..., 0] = (i - X / 2 + px)[:, None]
+    vertices[..., 1] = heightmap * height_scale + pz
+    vertices[..., 2] = j - Y / 2 + py
+    tex_coord = np.empty((x, y, 2), np.float32)
+    tex_coord[..., 0] = (i % 2)[:, None]
+    tex_coord[..., 1] = j % 2
+
+    return (vertices.reshape(-1, 3), tex_coord.reshape(-1, 2), gridIndex(x, y))
+
+
+def gridIndex(x, y):
+    """ uint32 triangle index of a regular grid of x by y vertices """
+    # vertex k = y*i + j is a corner of cell (i-1, j), split in 2 triangles
+    k = y * np.arange(1, x, dtype=np.uint32)[:, None] + np.arange(y - 1, dtype=np.uint32)
+    index = np.empty((x - 1, y - 1, 6), np.uint32)
+    index[..., 0] = index[..., 3] = k
+    index[..., 1] = index[..., 5] = k + 1 - y
+    index[..., 2] = k + 1
+    index[..., 4] = k - y
+    return index.ravel()
+
+
+def calcNormals(vertices, index, weighting='area'):
+    """ Smooth per-vertex normals, all faces computed and scattered at once.
+        weighting='area' sums raw face normals (larger faces weigh more),
+        weighting='angle' weights unit face normals by the corner angle """
+    vertices = np.array(vertices, np.float32)
+    index = np.array(index, np.uint32)
+    triangles = index.reshape(-1, 3)
+
+    # one (F, 3, 3) array holding the 3 corners of every triangle
+    corners = vertices[triangles]
+    edges_a = np.roll(corners, -1, axis=1) - corners  # corner -> next corner
+    edges_b = np.roll(corners, -2, axis=1) - corners  # corner -> previous one
+    face_normals = np.cross(edges_a[:, 0], edges_b[:, 0])  # length = 2 * area
+
+    if weighting == 'area':
+        contributions = np.repeat(face_normals[:, None, :], 3, axis=1)
+    elif weighting == 'angle':
+        lengths = np.linalg.norm(face_normals, axis=1, keepdims=True)
+        unit_normals = face_normals / np.maximum(lengths, 1e-12)
+        sines = np.linalg.norm(np.cross(edges_a, edges_b), axis=2)
+        angles = np.arctan2(sines, np.sum(edges_a * edges_b, axis=2))
+        contributions = unit_normals[:, None, :] * angles[:, :, None]
+    else:
+        raise ValueError('unknown normal weighting %r' % weighting)
+
+    # scatter-add every corner contribution onto its vertex, axis by axis
+    normals = np.zeros_like(vertices)
+    flat_index = triangles.ravel()
+    contributions = contributions.reshape(-1, 3)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(flat_index, contributions[:, axis],
+                                       minlength=len(vertices))
+
+    epsilon = 1e-8
+    normals /= np.sqrt(np.sum(normals ** 2, axis=1, keepdims=True) + epsilon)
+    return (normals, vertices, index)
+
+
+def waterMask(shape, lakes):
+    """ Boolean mask of the terrain vertices covered by water: the water
+        vertices (a, b) of lakes are terrain vertices (a - 1, b - 1) """
+    water = np.zeros(shape, bool)
+    for lake in lakes:
+        (a, b) = lake.lake.astype(int).T - 1
+        on_grid = (a >= 0) & (a < shape[0]) & (b >= 0) & (b < shape[1])
+        water[a[on_grid], b[on_grid]] = True
+    return water
+
+
+def treePositions(vertices, grass, count, rng=None):
+    """ Positions (x, z, y) of trees on count vertices drawn among the grass
+        vertex indices with rng, kept out of the 40 x 40 square of the volcano """
+    positions = vertices[np.random.default_rng(rng).choice(grass, count)]
+    return positions[np.maximum(abs(positions[:, 0]), abs(positions[:, 2])) >= 20]
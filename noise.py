@@ -0,0 +1,89 @@
+"""
+Coherent gradient noise (Perlin) and fractal Brownian motion for terrain
+heightmaps, vectorized over whole grids with numpy. Gradients are hashed from
+integer lattice coordinates and a seed, without permutation tables, so the
+noise is a pure function of position: tiles generated separately give the
+same values as one big heightmap, borders included.
+"""
+# External, non built-in modules
+import numpy as np          # all noise computations
+
+# 8 gradient directions picked by the lattice hash
+GRADIENTS = np.array([(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1)], np.float32)
+GRADIENTS /= np.linalg.norm(GRADIENTS, axis=1, keepdims=True)
+
+
+def _hash(ix, iy, seed):
+    """ uint32 hash of integer lattice coordinates and seed, well mixed """
+    with np.errstate(over='ignore'):  # arithmetic modulo 2^32 is the point
+        h = (ix.astype(np.uint32) * np.uint32(0x8da6b343)) ^ (iy.astype(np.uint32) * np.uint32(0xd8163841))
+        h ^= np.uint32(seed & 0xffffffff)
+        h ^= h >> np.uint32(16)
+        h *= np.uint32(0x7feb352d)
+        h ^= h >> np.uint32(15)
+        h *= np.uint32(0x846ca68b)
+        h ^= h >> np.uint32(16)
+    return h
+
+
+def _fade(t):
+    """ Perlin's quintic interpolation curve 6t^5 - 15t^4 + 10t^3 """
+    return t * t * t * (t * (t * 6 - 15) + 10)
+
+
+def perlin(x, y, seed=0):
+    """ 2D gradient noise at coordinates x, y (arrays broadcast together),
+        in [-1, 1], zero on integer coordinates """
+    x, y = np.asarray(x, np.float64), np.asarray(y, np.float64)
+    x0, y0 = np.floor(x), np.floor(y)
+    fx, fy = (x - x0).astype(np.float32), (y - y0).astype(np.float32)
+    ix, iy = x0.astype(np.int64), y0.astype(np.int64)
+
+    # gradients of the lattice points around all coordinates, hashed once each
+    (x_min, y_min) = (ix.min(), iy.min())
+    lattice = _hash(np.arange(x_min, ix.max() + 2)[:, None], np.arange(y_min, iy.max() + 2)[None, :], seed)
+    gx, gy = GRADIENTS.T[:, lattice & np.uint32(7)]
+    ix, iy = ix - x_min, iy - y_min
+    grid = ix.ndim == iy.ndim == 2 and ix.shape[1] == iy.shape[0] == 1  # (N,1) x and (1,M) y
+    flat = None if grid else ix * lattice.shape[1] + iy  # else 1D gathers in flattened lattices
+
+    def gather(lattice, dx, dy):  # values of lattice at (ix + dx, iy + dy)
+        if grid:  # rows then columns, much faster than a 2D gather
+            return lattice.take(ix[:, 0] + dx, axis=0).take(iy[0] + dy, axis=1)
+        return lattice.take(flat + (dx * lattice.shape[1] + dy))
+
+    def corner(dx, dy):  # gradient of corner (ix + dx, iy + dy) . offset to it
+        return gather(gx, dx, dy) * (fx - dx) + gather(gy, dx, dy) * (fy - dy)
+
+    u, v = _fade(fx), _fade(fy)
+    (n00, n10, n01, n11) = (corner(0, 0), corner(1, 0), corner(0, 1), corner(1, 1))
+    bottom, top = n00 + u * (n10 - n00), n01 + u * (n11 - n01)
+    return np.float32(np.sqrt(2)) * (bottom + v * (top - bottom))
+
+
+def fbm(x, y, seed=0, octaves=6, lacunarity=2.0, persistence=0.5):
+    """ Fractal Brownian motion: sum of octaves of perlin noise, each one
+        lacunarity times finer and persistence times weaker than the last,
+        normalized to [-1, 1] """
+    total, frequency, amplitude, weights = 0, 1.0, 1.0, 0.0
+    for octave in range(octaves):
+        total = total + amplitude * perlin(x * frequency, y * frequency, seed + 1000003 * octave)
+        weights += amplitude
+        frequency *= lacunarity
+        amplitude *= persistence
+    return total / weights
+
+
+def heightmap(shape, origin=(0, 0), seed=0, scale=32.0, octaves=6, lacunarity=2.0, persistence=0.5,
+              warp=0.0, height=1.0):
+    """ (x, y) heights in [0, height] of the grid vertices origin + (i, j),
+        from fbm noise with features of 'scale' vertices. warp > 0 displaces
+        the noise domain by warp times another fbm noise, in scale units """
+    (i0, j0) = origin
+    x = (np.arange(i0, i0 + shape[0], dtype=np.float64) / scale)[:, None]
+    y = (np.arange(j0, j0 + shape[1], dtype=np.float64) / scale)[None, :]
+    if warp:
+        octaves_warp = min(octaves, 3)
+        x, y = (x + warp * fbm(x, y, seed + 1, octaves_warp, lacunarity, persistence),
+                y + warp * fbm(x, y, seed + 2, octaves_warp, lacunarity, persistence))
+    return (0.5 + 0.5 * fbm(x, y, seed, octaves, lacunarity, persistence)) * height
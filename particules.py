@@ -1,8 +1,8 @@
 import OpenGL.GL as GL  # standard Python OpenGL wrapper
+import glfw  # lean window system wrapper for OpenGL
 
 import numpy as np  # all matrix manipulations & OpenGL args
-from core import Mesh, Node
-import random
+from core import Mesh, Node, frame_stats
 from texture import Textured
 from transform import vec, quaternion
 from animation import (KeyFrameControlNode)
@@ -20,21 +20,25 @@ class Particule(Textured):
         self.position = np.array(position, np.float32)
         self.shinyness = shinyness
         self.scale = scale
+        self.rotation = None  # trackball rotation the vertices were built for
         mesh = Mesh(shader, attributes=dict(position=self.vertices+self.position, tex_coord=np.array(tex_coord), normal=normals),
-                    index=index, s=shinyness, light_dir=light_dir)
+                    index=index, usage=GL.GL_DYNAMIC_DRAW, s=shinyness, light_dir=light_dir)
         super().__init__(mesh, diffuse_map=texture)
     
     def updateOrientation(self):
-        rotationMatrix = self.viewer.trackball.matrix()
-        matrix = rotationMatrix[:3, :3]
-        vertices_ = np.zeros_like(self.vertices, np.float32)
-        vertices_ = np.array([sous_tableau @ matrix for sous_tableau in self.vertices], np.float32)
-        #(normals_, vertices_, index_) = calcNormals(vertices_, self.index)
-        self.drawable.setAttributes(dict(position=vertices_, tex_coord=np.array(self.tex_coord), normal=self.normals))
+        """ Camera facing vertices, or None if the camera did not rotate """
+        rotation = self.viewer.trackball.rotation
+        if self.rotation is not None and np.array_equal(rotation, self.rotation):
+            return None
+        self.rotation = rotation.copy()
+        matrix = self.viewer.trackball.matrix()[:3, :3]
+        return np.ascontiguousarray(self.vertices @ matrix + self.position, np.float32)
     
     def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        self.updateOrientation()
-        return super().draw(primitives, **uniforms)
+        # rewrite the existing position buffer in place, no new GL objects
+        vertices = self.updateOrientation()
+        attributes = None if vertices is None else dict(position=vertices)
+        return super().draw(primitives, attributes=attributes, **uniforms)
 
 class leafParticle(Particule):
     def __init__(self, viewer, shader, light_dir, texture, position=(0,0,0), shinyness=2, scale=1) :
@@ -54,16 +58,87 @@ class FallingLeaf(KeyFrameControlNode):
         self.add(leafParticle(viewer, shader, light_dir, texture, (0,0,0), shinyness, scale))
 
 class FallingLeaves(Node):
-    def __init__(self, viewer, shader, light_dir, height, texture, position=(0,0,0), shinyness=2, ray=1):
+    def __init__(self, viewer, shader, light_dir, height, texture, position=(0,0,0), shinyness=2, ray=1, rng=None):
         super().__init__()
-        nbLeaves = random.randint(0, 2)
+        rng = np.random.default_rng(rng)
+        nbLeaves = rng.integers(0, 3)
         for leave in range(nbLeaves):
             (x,z,y) = position
-            theta = np.random.uniform(0, 2*np.pi)  # angle aléatoire
-            s = np.random.uniform(0, ray/2)  # distance aléatoire dans le rayon
+            theta = rng.uniform(0, 2*np.pi)  # angle aléatoire
+            s = rng.uniform(0, ray/2)  # distance aléatoire dans le rayon
             x = x + s*np.cos(theta)  # nouvelle coordonnée x
             y = y + s*np.sin(theta)  # nouvelle coordonnée y
 
-            animationShift = random.randint(0,9)
+            animationShift = rng.integers(0, 10)
             self.add(FallingLeaf(viewer, shader, light_dir, height, texture, (x,z,y), repeat=True, animationShift=animationShift))
-        
\ No newline at end of file
+
+
+class ParticleSystem(Textured):
+    """ All the falling leaves of a scene in one instanced billboard mesh,
+        animated by a single vectorized numpy update per frame """
+
+    # fall of a leaf along time, as a fraction of its height (see FallingLeaf)
+    FALL_TIMES = (0, 3, 4, 5)
+    FALL_FRACTIONS = (0, 0.9, 0.98, 1)
+
+    def __init__(self, shader, texture):
+        self.shader = shader
+        self.origins = np.zeros((0, 3), np.float32)  # leaf start positions
+        self.heights = np.zeros(0, np.float32)  # fall height of each leaf
+        self.shifts = np.zeros(0, np.float32)  # animation shift in seconds
+        self.scales = np.zeros(0, np.float32)  # billboard size of each leaf
+        super().__init__(None, diffuse_map=texture)
+
+    def emit(self, origins, heights, shifts=0, scales=1):
+        """ Add leaves falling from (N,3) origins, looping after FALL_TIMES """
+        origins = np.asarray(origins, np.float32).reshape(-1, 3)
+        count = len(origins)
+        self.origins = np.concatenate((self.origins, origins))
+        self.heights = np.concatenate((self.heights, np.broadcast_to(np.float32(heights), count)))
+        self.shifts = np.concatenate((self.shifts, np.broadcast_to(np.float32(shifts), count)))
+        self.scales = np.concatenate((self.scales, np.broadcast_to(np.float32(scales), count)))
+        self.drawable = None  # instance buffers are resized on next draw
+
+    def addLeaves(self, height, position=(0, 0, 0), ray=1, count=None, rng=None):
+        """ A few leaves falling from a foliage of radius ray, like FallingLeaves,
+            drawn with rng (numpy Generator or seed) """
+        rng = np.random.default_rng(rng)
+        count = rng.integers(0, 3) if count is None else count
+        (x, z, y) = position
+        theta = rng.uniform(0, 2 * np.pi, count)  # angle aléatoire
+        s = rng.uniform(0, ray / 2, count)  # distance aléatoire dans le rayon
+        origins = np.stack((x + s * np.cos(theta), np.full(count, z), y + s * np.sin(theta)), axis=-1)
+        self.emit(origins, height, rng.integers(0, 10, count))
+
+    def addLeavesFrom(self, heights, positions, rays, rng=None):
+        """ addLeaves for many foliages at once, from (N,) heights, (N,3)
+            positions and (N,) rays """
+        rng = np.random.default_rng(rng)
+        positions = np.asarray(positions, np.float32).reshape(-1, 3)
+        counts = rng.integers(0, 3, len(positions))
+        owners = np.repeat(np.arange(len(positions)), counts)
+        theta = rng.uniform(0, 2 * np.pi, len(owners))
+        s = rng.uniform(0, 1, len(owners)) * np.asarray(rays, np.float32)[owners] / 2
+        origins = positions[owners] + np.stack((s * np.cos(theta), np.zeros(len(owners)), s * np.sin(theta)), axis=-1)
+        self.emit(origins, np.asarray(heights, np.float32)[owners], rng.integers(0, 10, len(owners)))
+
+    def update(self, time):
+        """ Position and fall progress of every leaf at time, all at once """
+        age = (np.float32(time) + self.shifts) % np.float32(self.FALL_TIMES[-1])
+        self.phase = age / np.float32(self.FALL_TIMES[-1])
+        self.positions = self.origins.copy()
+        self.positions[:, 1] -= np.interp(age, self.FALL_TIMES, self.FALL_FRACTIONS).astype(np.float32) * self.heights
+
+    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+        if len(self.origins) == 0:
+            return
+        time = uniforms.get('time')  # frame time passed down by the viewer
+        self.update(glfw.get_time() if time is None else time)
+        if self.drawable is None:
+            vertices = [[-0.5, -0.5, 0], [0.5, -0.5, 0], [-0.5, 0.5, 0], [0.5, 0.5, 0]]
+            tex_coord = [[0, 1], [1, 1], [0, 0], [1, 0]]
+            instances = dict(offset=self.positions, phase=self.phase, size=self.scales)
+            self.drawable = Mesh(self.shader, attributes=dict(position=vertices, tex_coord=tex_coord),
+                                 index=[0, 1, 3, 0, 3, 2], usage=GL.GL_DYNAMIC_DRAW, instances=instances)
+        frame_stats.count('particles', len(self.origins))
+        super().draw(primitives, attributes=dict(offset=self.positions, phase=self.phase), **uniforms)
@@ -1,7 +1,9 @@
 import OpenGL.GL as GL
-from PIL import Image
+import numpy as np
 import os
-from core import Mesh
+from itertools import chain
+from core import Mesh, frame_stats
+from texture import decode_images, read_mip_chain, upload_mip_chain
 from textures import TexturedCube
 
 FILE_OPENING_CONFIG = 'RGBA'
@@ -22,14 +24,22 @@ class SkyBox(TexturedCube):
             def __init__(self, tex_path):
                 self.glid = GL.glGenTextures(1)
                 self.type = GL.GL_TEXTURE_CUBE_MAP
-                i = 0
-                for file in sorted(os.listdir(tex_path)):
-                    # Load the texture
-                    tex_file = os.path.join(tex_path, file)
-                    tex = Image.open(tex_file).convert(FILE_OPENING_CONFIG)
+                self.transparent = False
+                frame_stats.count('GL objects created')
+                faces = [os.path.join(tex_path, file) for file in sorted(os.listdir(tex_path))
+                         if not file.endswith('.mip')]
+                # converted faces are read as is, the others are decoded in
+                # parallel; upload each one when ready
+                converted = {face: read_mip_chain(face) for face in faces}
+                sources = [face for face in faces if converted[face] is None]
+                images = chain(((face, levels[0]) for face, levels in converted.items()
+                                if levels is not None),
+                               ((face, np.asarray(tex)) for face, tex
+                                in decode_images(sources, FILE_OPENING_CONFIG)))
+                for tex_file, pixels in images:
+                    i = faces.index(tex_file)
                     GL.glBindTexture(self.type, self.glid)
-                    GL.glTexImage2D(GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i, 0, GL.GL_RGBA, tex.width, tex.height,
-                                    0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex.tobytes())
+                    upload_mip_chain(self.type, [pixels], GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i)
 
                     # Set parameters to smooth the limit between skybox textures
                     GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
@@ -37,7 +47,6 @@ class SkyBox(TexturedCube):
                     GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
                     GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
                     GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_R, GL.GL_CLAMP_TO_EDGE)
-                    i += 1
 
         mesh = Mesh(shader, attributes=dict(position=coords))
         texture = Texture(tex_path)
@@ -0,0 +1,40 @@
+"""
+Headless tests of the view frustum culling of transform.py: the clip planes
+come from perspective @ lookat matrices, no OpenGL context is needed.
+Run with: python -m pytest test_transform.py
+"""
+# External, non built-in modules
+import numpy as np
+
+from transform import boxes_in_frustum, frustum_planes, lookat, perspective, vec
+
+
+def camera_planes():
+    """ Planes of a camera at the origin looking down -z, 90 degrees field
+        of view, near plane at 1 and far plane at 100 """
+    view = lookat(vec(0, 0, 0), vec(0, 0, -1), vec(0, 1, 0))
+    return frustum_planes(perspective(90, 1, 1, 100) @ view)
+
+
+def test_box_in_front_is_kept():
+    assert boxes_in_frustum(camera_planes(), (-1, -1, -11), (1, 1, -9)).tolist() == [True]
+
+
+def test_box_behind_is_culled():
+    assert boxes_in_frustum(camera_planes(), (-1, -1, 9), (1, 1, 11)).tolist() == [False]
+
+
+def test_boxes_out_of_side_and_far_planes_are_culled():
+    box_min = np.array([(20, -1, -11), (-1, -1, -300)], np.float32)
+    assert boxes_in_frustum(camera_planes(), box_min, box_min + 2).tolist() == [False, False]
+
+
+def test_box_straddling_a_plane_is_kept():
+    # crosses the right plane x = -z and the near plane z = -1
+    box_min = np.array([(5, -1, -11), (-1, -1, -2)], np.float32)
+    box_max = np.array([(15, 1, -9), (1, 1, 2)], np.float32)
+    assert boxes_in_frustum(camera_planes(), box_min, box_max).tolist() == [True, True]
+
+
+def test_planes_are_normalized():
+    assert np.allclose(np.linalg.norm(camera_planes()[:, :3], axis=1), 1)
@@ -1,7 +1,13 @@
+import os  # absolute texture paths
+from collections import OrderedDict  # least recently used ordering
+from concurrent.futures import ThreadPoolExecutor, as_completed  # image decoding
+
 import OpenGL.GL as GL  # standard Python OpenGL wrapper
 from PIL import Image  # load texture maps
 import numpy as np  # all matrix manipulations & OpenGL args
-from core import Node
+from core import Mesh, Node, frame_stats
+from geometry import calcNormals
+from transform import identity
 
 
 # -------------- OpenGL Texture Wrapper ---------------------------------------
@@ -10,37 +16,275 @@ class Texture:
 
     def __init__(self, tex_file, wrap_mode=GL.GL_REPEAT,
                  mag_filter=GL.GL_LINEAR, min_filter=GL.GL_LINEAR_MIPMAP_LINEAR,
-                 tex_type=GL.GL_TEXTURE_2D):
+                 tex_type=GL.GL_TEXTURE_2D, image=None):
         self.glid = GL.glGenTextures(1)
         self.type = tex_type
+        self.nbytes = 0  # estimated GPU memory, including mipmaps
+        self.transparent = False  # has texels with alpha < 1, to be blended
+        frame_stats.count('GL objects created')
+        # leave the texture bound on the active unit as we found it
+        previous = GL.glGetIntegerv(TEXTURE_BINDINGS.get(tex_type, GL.GL_TEXTURE_BINDING_2D))
+        # converted mipmap chain if any, else the already decoded image if
+        # given (see decode_images), else imported from file
+        levels = read_mip_chain(tex_file) if image is None else None
         try:
-            # imports image as a numpy array in exactly right format
-            tex = Image.open(tex_file).convert('RGBA')
             GL.glBindTexture(tex_type, self.glid)
-            GL.glTexImage2D(tex_type, 0, GL.GL_RGBA, tex.width, tex.height,
-                            0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex.tobytes())
+            if levels is None:
+                # imports image as a numpy array in exactly right format
+                tex = image if image is not None else Image.open(tex_file).convert('RGBA')
+                GL.glTexImage2D(tex_type, 0, GL.GL_RGBA, tex.width, tex.height,
+                                0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex.tobytes())
+                GL.glGenerateMipmap(tex_type)
+                self.nbytes = mipmap_bytes(tex.width, tex.height)
+                self.transparent = tex.getextrema()[3][0] < 255
+            else:
+                upload_mip_chain(tex_type, levels)
+                self.nbytes = sum(level.nbytes for level in levels)
+                self.transparent = levels[0].shape[2] in (2, 4) and levels[0][..., -1].min() < 255
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_S, wrap_mode)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_T, wrap_mode)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MIN_FILTER, min_filter)
             GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
-            GL.glGenerateMipmap(tex_type)
         except FileNotFoundError:
             print("ERROR: unable to load texture file %s" % tex_file)
+        GL.glBindTexture(tex_type, previous)
 
     def __del__(self):  # delete GL texture from GPU when object dies
         GL.glDeleteTextures(self.glid)
 
 
+def decode_image(tex_file, mode='RGBA'):
+    """ Pixels of an image file converted to mode, None if there is no file """
+    try:
+        return Image.open(tex_file).convert(mode)
+    except FileNotFoundError:
+        return None
+
+
+def decode_images(tex_files, mode='RGBA', workers=None):
+    """ Decodes image files on a thread pool (PIL releases the GIL while
+        decoding), yielding (tex_file, image) pairs as soon as each is ready
+        so that the caller uploads them from the thread owning the GL context """
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(decode_image, tex_file, mode): tex_file
+                   for tex_file in tex_files}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+TEXTURE_BINDINGS = {GL.GL_TEXTURE_2D: GL.GL_TEXTURE_BINDING_2D,
+                    GL.GL_TEXTURE_CUBE_MAP: GL.GL_TEXTURE_BINDING_CUBE_MAP}
+
+
+# -------------- Pre-mipmapped texture files ---------------------------------
+# A .mip file holds the 4 bytes MIP_MAGIC, then width, height and channels as
+# uint32, then the raw 8 bit pixels of every mipmap level, from full size
+# down to 1x1, each one half the size of the previous one (rounded down).
+MIP_MAGIC = b'MIP1'
+PIXEL_FORMATS = {1: GL.GL_RED, 2: GL.GL_RG, 3: GL.GL_RGB, 4: GL.GL_RGBA}
+
+
+def mip_chain_file(tex_file):
+    """ Converted file of an image file, next to it. The whole image file
+        name is kept, so leaf.png and leaf.jpg get different .mip files """
+    return tex_file + '.mip'
+
+
+def mip_sizes(width, height):
+    """ (width, height) of each mipmap level, down to 1x1 """
+    sizes = [(width, height)]
+    while sizes[-1] != (1, 1):
+        sizes.append((max(sizes[-1][0] // 2, 1), max(sizes[-1][1] // 2, 1)))
+    return sizes
+
+
+def convert_texture(tex_file, mode='RGBA', mip_file=None):
+    """ Writes the mipmap chain of an image file, box filtered, as a .mip file;
+        mode 'L' keeps a single 8 bit channel """
+    mip_file = mip_file or mip_chain_file(tex_file)
+    image = Image.open(tex_file).convert(mode)
+    with open(mip_file + '.tmp', 'wb') as file:
+        file.write(MIP_MAGIC)
+        file.write(np.array((*image.size, len(image.getbands())), np.uint32).tobytes())
+        for size in mip_sizes(*image.size):
+            file.write(image.resize(size, Image.BOX).tobytes())
+    os.replace(mip_file + '.tmp', mip_file)
+    return mip_file
+
+
+def read_mip_chain(tex_file, mip_file=None):
+    """ Mipmap levels of an image file as (height, width, channels) uint8
+        arrays memory mapped from its .mip file, None when there is no such
+        file, when the image was modified after its conversion, or when the
+        file is not a whole .mip file (truncated or corrupt) """
+    mip_file = mip_file or mip_chain_file(tex_file)
+    try:
+        if os.path.getmtime(mip_file) < os.path.getmtime(tex_file):
+            return None
+    except FileNotFoundError:
+        if not os.path.exists(mip_file):
+            return None
+    if os.path.getsize(mip_file) < 16:  # not even a header, memmap fails on empty files
+        return None
+    data = np.memmap(mip_file, np.uint8, 'r')
+    if bytes(data[:4]) != MIP_MAGIC:
+        return None
+    width, height, channels = (int(value) for value in data[4:16].view(np.uint32))
+    if min(width, height) < 1 or channels not in PIXEL_FORMATS or \
+            16 + sum(w * h * channels for (w, h) in mip_sizes(width, height)) != data.size:
+        return None
+    levels, offset = [], 16
+    for (level_width, level_height) in mip_sizes(width, height):
+        size = level_width * level_height * channels
+        levels.append(data[offset:offset + size].reshape(level_height, level_width, channels))
+        offset += size
+    return levels
+
+
+def upload_mip_chain(tex_type, levels, target=None):
+    """ Uploads mipmap levels to the bound texture, target defaults to tex_type """
+    target = target or tex_type
+    pixel_format = PIXEL_FORMATS[levels[0].shape[2]]
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)  # rows are not padded
+    for level, pixels in enumerate(levels):
+        GL.glTexImage2D(target, level, pixel_format, pixels.shape[1], pixels.shape[0],
+                        0, pixel_format, GL.GL_UNSIGNED_BYTE, pixels)
+    GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+    if pixel_format == GL.GL_RED:  # single 8 bit channel is read as grey
+        GL.glTexParameteriv(tex_type, GL.GL_TEXTURE_SWIZZLE_RGBA,
+                            (GL.GL_RED, GL.GL_RED, GL.GL_RED, GL.GL_ONE))
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+
+
+def mipmap_bytes(width, height, texel_bytes=4):
+    """ Memory size of a texture and its full mipmap chain down to 1x1 """
+    total = 0
+    while True:
+        total += width * height * texel_bytes
+        if width == height == 1:
+            return total
+        width, height = max(width // 2, 1), max(height // 2, 1)
+
+
+# -------------- Texture cache ------------------------------------------------
+class CachedTexture:
+    """ Texture handle given by a TextureCache. Binding it (reading glid)
+        reloads the texture if it was evicted, and marks it recently used """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key  # (tex_file, wrap_mode, mag_filter, min_filter, tex_type)
+        self.type = key[-1]
+        self.texture = None  # loaded Texture, None while evicted
+        self.transparent = False  # of the texture, known once loaded
+        self.evicted = False  # next load is a reload
+
+    @property
+    def glid(self):
+        return self.cache.bind(self).glid
+
+    @property
+    def nbytes(self):
+        return self.texture.nbytes if self.texture else 0
+
+
+class TextureCache:
+    """ Loads each texture file once per set of parameters, and keeps the
+        estimated GPU memory of loaded textures under a budget by evicting
+        the least recently bound ones, which are reloaded when bound again """
+
+    def __init__(self, budget=256 * 2**20):
+        self.budget = budget  # in bytes
+        self.handles = {}  # key -> CachedTexture
+        self.loaded = OrderedDict()  # key -> CachedTexture, recently bound last
+        self.stats = dict(hits=0, misses=0, evictions=0, reloads=0)
+
+    def get(self, tex_file, wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_LINEAR,
+            min_filter=GL.GL_LINEAR_MIPMAP_LINEAR, tex_type=GL.GL_TEXTURE_2D, image=None):
+        """ Texture handle for these parameters, loaded now on first request,
+            from its already decoded image if given """
+        key = (os.path.abspath(tex_file), wrap_mode, mag_filter, min_filter, tex_type)
+        if key in self.handles:
+            self.stats['hits'] += 1
+            return self.handles[key]
+        self.stats['misses'] += 1
+        handle = self.handles[key] = CachedTexture(self, key)
+        self.bind(handle, image)
+        return handle
+
+    def load(self, *tex_files, **params):
+        """ Texture handles of several files, like get, but decoding all the
+            new images in parallel and uploading each one as soon as ready """
+        handles = {}
+        new_files = [tex_file for tex_file in dict.fromkeys(tex_files)
+                     if (os.path.abspath(tex_file), *self._params(**params)) not in self.handles]
+        for tex_file in [tex_file for tex_file in new_files
+                         if read_mip_chain(tex_file) is not None]:
+            handles[tex_file] = self.get(tex_file, **params)  # nothing to decode
+        for tex_file, image in decode_images(set(new_files) - set(handles)):
+            handles[tex_file] = self.get(tex_file, image=image, **params)
+        return [handles.get(tex_file) or self.get(tex_file, **params) for tex_file in tex_files]
+
+    @staticmethod
+    def _params(wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_LINEAR,
+                min_filter=GL.GL_LINEAR_MIPMAP_LINEAR, tex_type=GL.GL_TEXTURE_2D):
+        """ Texture parameters part of the cache key, with get's defaults """
+        return wrap_mode, mag_filter, min_filter, tex_type
+
+    def bind(self, handle, image=None):
+        """ Loaded Texture of handle, now the most recently used one """
+        if handle.texture is None:
+            self.stats['reloads'] += handle.evicted
+            tex_file, wrap_mode, mag_filter, min_filter, tex_type = handle.key
+            handle.texture = Texture(tex_file, wrap_mode, mag_filter, min_filter, tex_type, image)
+            handle.transparent = handle.texture.transparent
+            self.loaded[handle.key] = handle
+            self.evict(keep=handle)
+        self.loaded.move_to_end(handle.key)
+        return handle.texture
+
+    def evict(self, keep=None):
+        """ Drop least recently bound textures until we are within budget """
+        for key in list(self.loaded):
+            if self.gpu_bytes() <= self.budget:
+                return
+            if self.loaded[key] is not keep:
+                handle = self.loaded.pop(key)
+                handle.texture, handle.evicted = None, True  # GL texture deleted
+                self.stats['evictions'] += 1
+
+    def gpu_bytes(self):
+        """ Estimated GPU memory of all loaded textures """
+        return sum(handle.nbytes for handle in self.loaded.values())
+
+    def report(self):
+        """ Human readable statistics """
+        return ('textures: %d loaded / %d known, %.1f / %.1f MB, %d hits, %d misses, '
+                '%d evictions, %d reloads' % (len(self.loaded), len(self.handles),
+                                              self.gpu_bytes() / 2**20, self.budget / 2**20,
+                                              *self.stats.values()))
+
+
+texture_cache = TextureCache()  # shared by the whole application
+
+
 # -------------- Textured mesh decorator --------------------------------------
 class Textured(Node):
     """ Drawable mesh decorator that activates and binds OpenGL textures """
+    depth_func = GL.GL_LESS  # depth test when drawn from a RenderQueue
 
     def __init__(self, drawable, **textures):
         super().__init__()
         self.drawable = drawable
         self.textures = textures
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+    def draw(self, primitives=GL.GL_TRIANGLES, queue=None, **uniforms):
+        if queue is not None:  # textures bound and blending set by the queue
+            uniforms.update((name, index) for index, name in enumerate(self.textures))
+            blend = any(getattr(texture, 'transparent', True) for texture in self.textures.values())
+            queue.push(self.drawable, primitives, uniforms, self.textures.values(),
+                       blend, self.depth_func)
+            return
         for index, (name, texture) in enumerate(self.textures.items()):
             GL.glActiveTexture(GL.GL_TEXTURE0 + index)
             GL.glBindTexture(texture.type, texture.glid)
@@ -50,22 +294,58 @@ class Textured(Node):
         self.drawable.draw(primitives=primitives, **uniforms)
         GL.glDisable(GL.GL_BLEND)
 
-def calcNormals(vertices, index):
-    vertices = np.array(vertices, np.float32)
-    index = np.array(index, np.uint32)
-    normals = np.zeros_like(vertices)
-    
-    (index_size,) = index.shape
-    
-    for k in range(0, index_size, 3):
-         # Calculate triangle normal
-        v1, v2, v3 = vertices[index[k]], vertices[index[k+1]], vertices[index[k+2]]
-        tri_normal = np.cross(v2 - v1, v3 - v1)
-        # Add triangle normal to vertex normals
-        normals[index[k]] += tri_normal
-        normals[index[k+1]] += tri_normal
-        normals[index[k+2]] += tri_normal
-
-    epsilon = 1e-8
-    normals = np.array([n / np.sqrt(np.sum(n ** 2) + epsilon) for n in normals])
-    return (normals, vertices, index)
\ No newline at end of file
+# -------------- Static batching ----------------------------------------------
+class StaticBatch(Node):
+    """ Draws a subtree whose transforms never change with one mesh per
+        (shader, textures, uniforms): world transforms are baked into vertex
+        positions and normals, and meshes merged into one vertex array.
+        Drawables that cannot be merged are kept, under their world transform """
+
+    def __init__(self, node):
+        super().__init__()
+        groups = {}  # merge key -> [shader, textures, uniforms, [(mesh, world)]]
+        for drawable, world in self._leaves(node, identity()):
+            mesh = getattr(drawable, 'drawable', None)
+            if (type(drawable).draw is not Textured.draw or type(mesh) is not Mesh
+                    or mesh.attributes is None or mesh.instances or mesh.usage != GL.GL_STATIC_DRAW):
+                self.add(Node([drawable], transform=world))
+                continue
+            uniforms = sorted(mesh.uniforms.items())
+            key = (mesh.shader, tuple(drawable.textures.items()), tuple(sorted(mesh.attributes)),
+                   tuple((name, np.asarray(value).tobytes()) for name, value in uniforms))
+            groups.setdefault(key, [mesh.shader, drawable.textures, mesh.uniforms, []])[3].append((mesh, world))
+        for shader, textures, uniforms, meshes in groups.values():
+            attributes, index = self._merge(meshes)
+            self.add(Textured(Mesh(shader, attributes, index, **uniforms), **textures))
+
+    @staticmethod
+    def _leaves(node, model):
+        """ (drawable, world transform) of non Node drawables in subtree """
+        if type(node).draw is not Node.draw:
+            yield node, model
+            return
+        model = model @ node.transform
+        for child in node.children:
+            yield from StaticBatch._leaves(child, model)
+
+    @staticmethod
+    def _merge(meshes):
+        """ Attributes and index of all (mesh, world) pairs, in world space """
+        attributes = {name: [] for name in meshes[0][0].attributes}
+        index, offset = [], 0
+        for mesh, world in meshes:
+            world = np.asarray(world, np.float32)
+            normal_matrix = np.linalg.inv(world[:3, :3]).T
+            for name, data in mesh.attributes.items():
+                data = np.asarray(data, np.float32)
+                if name == 'position':
+                    data = data @ world[:3, :3].T + world[:3, 3]
+                elif name == 'normal':
+                    data = data @ normal_matrix.T
+                    data /= np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-8)
+                attributes[name].append(data)
+            count = len(attributes['position'][-1])
+            mesh_index = np.arange(count) if mesh.index is None else np.asarray(mesh.index)
+            index.append(mesh_index.astype(np.uint32) + offset)
+            offset += count
+        return {name: np.concatenate(arrays) for name, arrays in attributes.items()}, np.concatenate(index)
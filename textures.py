@@ -1,61 +1,323 @@
 from animation import KeyFrameControlNode
-from texture import Textured, calcNormals
+from texture import StaticBatch, Textured
+from geometry import calcNormals, gridIndex, gridMesh, treePositions, waterMask
 
 import OpenGL.GL as GL  # standard Python OpenGL wrapper
 import numpy as np  # all matrix manipulations & OpenGL args
-from core import Mesh, Node, load
+from core import IndexBuffer, Mesh, Node, VertexArray, assets, frame_stats, gl_state
 import random
-from particules import FallingLeaves
-from transform import quaternion, quaternion_from_euler, vec
+from collections import deque
+from particules import ParticleSystem
+from transform import quaternion, quaternion_from_euler, vec, frustum_planes, boxes_in_frustum
+
+
+def lodIndex(x, y, level, edge_levels=(0, 0, 0, 0)):
+    """ uint32 triangle index of an x by y vertices tile keeping one vertex
+        every 2**level. Tile borders (i=0, i=x-1, j=0, j=y-1) keep one vertex
+        every 2**edge_level so that neighbour tiles agreeing on the level of
+        their shared border have exactly the same vertices along it: finer
+        borders are fanned, coarser ones collapse their extra vertices """
+    if level == 0:
+        index = gridIndex(x, y)
+        if max(edge_levels) > 0:  # corner cells split through their corner, as below
+            cells = index.reshape(x - 1, y - 1, 6)
+            for (i, j) in ((0, 0), (x - 2, y - 2)):
+                (k0, k1) = (i * y + j, (i + 1) * y + j)  # vertices (i, j), (i + 1, j)
+                cells[i, j] = (k0, k1 + 1, k1, k0, k0 + 1, k1 + 1)
+        return lodCollapse(index, x, y, level, edge_levels)
+
+    def samples(size, step):  # coarse vertex coordinates along one axis
+        return list(range(0, size - 1, step)) + [size - 1]
+
+    rows, cols = samples(x, 2 ** level), samples(y, 2 ** level)
+    corners = {(0, 0), (len(rows) - 2, len(cols) - 2)}
+    triangles = []
+    for a, (i0, i1) in enumerate(zip(rows, rows[1:])):
+        for b, (j0, j1) in enumerate(zip(cols, cols[1:])):
+            # pick the diagonal so that no triangle has two edges on a border
+            if (a, b) in corners:
+                triangles += [((i0, j0), (i1, j1), (i1, j0)), ((i0, j0), (i0, j1), (i1, j1))]
+            else:
+                triangles += [((i0, j0), (i0, j1), (i1, j0)), ((i1, j0), (i0, j1), (i1, j1))]
+
+    # fan the triangles having an edge on a border over the border vertices
+    borders = ((0, 0, 0), (0, x - 1, 1), (1, 0, 2), (1, y - 1, 3))  # axis, value, side
+    index = []
+    for triangle in triangles:
+        for k in range(3):
+            start, end, apex = triangle[k], triangle[(k + 1) % 3], triangle[(k + 2) % 3]
+            side = next((side for axis, value, side in borders
+                         if start[axis] == value and end[axis] == value), None)
+            if side is not None:
+                break
+        if side is None:
+            index += [i * y + j for i, j in triangle]
+            continue
+        axis = 1 - borders[side][0]  # coordinate running along the border
+        step = 2 ** min(edge_levels[side], level)
+        inner = [c for c in range(min(start[axis], end[axis]) + 1, max(start[axis], end[axis]))
+                 if c % step == 0]
+        inner = inner if start[axis] < end[axis] else inner[::-1]
+        fan = [start] + [tuple(c if n == axis else start[n] for n in range(2)) for c in inner] + [end]
+        for first, second in zip(fan, fan[1:]):
+            index += [i * y + j for i, j in (first, second, apex)]
+    return lodCollapse(np.array(index, np.uint32), x, y, level, edge_levels)
+
+
+def lodCollapse(index, x, y, level, edge_levels):
+    """ index with the vertices of borders coarser than level merged into the
+        previous vertex kept on their border, and the triangles this flattens
+        removed. Other vertices of the triangles being off the border, the
+        remaining triangles keep their orientation """
+    if max(edge_levels) <= level:
+        return index
+    remap = np.arange(x * y, dtype=np.uint32).reshape(x, y)
+    for side, line in enumerate((remap[0], remap[-1], remap[:, 0], remap[:, -1])):
+        if edge_levels[side] > level:
+            c = np.arange(len(line))
+            kept = (c % 2 ** edge_levels[side] == 0) | (c == len(line) - 1)
+            line[:] = line[np.maximum.accumulate(np.where(kept, c, 0))]
+    triangles = remap.ravel()[index].reshape(-1, 3)
+    flat = ((triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2])
+            | (triangles[:, 2] == triangles[:, 0]))
+    return triangles[~flat].ravel()
+
+
+def lodLevels(distances, lod_distance, max_levels):
+    """ Level of detail for each distance: 0 (full resolution) up to
+        lod_distance, then one more level each time the distance doubles """
+    levels = np.floor(np.log2(np.maximum(distances, 1e-6) / lod_distance)) + 1
+    return np.clip(levels, 0, max_levels).astype(int)
+
+
+def tileReduce(function, array, chunk_size):
+    """ function (np.minimum, np.maximum) of an (x, y, ...) array over each
+        tile of chunk_size cells, tiles sharing their border rows and columns """
+    for axis in (0, 1):
+        array = np.moveaxis(array, axis, 0)
+        start = np.arange(0, max(len(array) - 1, 1), chunk_size)
+        blocks = function.reduceat(array, start, 0)
+        blocks[:-1] = function(blocks[:-1], array[start[1:]])
+        array = np.moveaxis(blocks, 0, axis)
+    return array
+
+
+def pairReduce(function, array):
+    """ function of an (x, y, ...) array over its 2 x 2 blocks, odd sides
+        extended by their last row or column """
+    (x, y) = array.shape[:2]
+    array = np.pad(array, [(0, x % 2), (0, y % 2)] + [(0, 0)] * (array.ndim - 2), mode='edge')
+    blocks = array.reshape(len(array) // 2, 2, array.shape[1] // 2, 2, *array.shape[2:])
+    return function.reduce(function.reduce(blocks, axis=3), axis=1)
+
+
+class TerrainQuadtree:
+    """ Quadtree over the square tiles of a grid mesh. A node of level k
+        gathers 2**k x 2**k tiles of chunk_size cells and keeps one vertex out
+        of 2**k, so that all nodes have the triangles of one tile: far away,
+        tiles are merged into larger nodes rather than drawn coarser, and
+        triangles and draw calls only grow with the log of the terrain size """
+
+    def __init__(self, positions, chunk_size=32):
+        """ positions: (x, y, 3) vertex positions of the grid """
+        if chunk_size % 2:
+            raise ValueError('chunk_size must be even, not %r' % chunk_size)
+        self.size = positions.shape[:2]
+        self.chunk_size = chunk_size
+        # bounding boxes of the nodes, level by level up to a single root
+        self.box_min = [tileReduce(np.minimum, positions, chunk_size)]
+        self.box_max = [tileReduce(np.maximum, positions, chunk_size)]
+        while max(self.box_min[-1].shape[:2]) > 1:
+            self.box_min.append(pairReduce(np.minimum, self.box_min[-1]))
+            self.box_max.append(pairReduce(np.maximum, self.box_max[-1]))
+        self.tiles = self.box_min[0].shape[:2]
+        self.depth = len(self.box_min) - 1
+
+    def samples(self, level, a, b):
+        """ Grid rows and columns of the vertices kept by node (level, a, b) """
+        span = self.chunk_size * 2 ** level
+        return tuple(np.append(np.arange(start, end, 2 ** level), end)
+                     for start, end in ((c * span, min((c + 1) * span, n - 1)) for c, n in zip((a, b), self.size)))
+
+    def expand(self, mask, level):
+        """ Per tile values of a per node mask of a level """
+        mask = np.repeat(np.repeat(mask, 2 ** level, axis=0), 2 ** level, axis=1)
+        return mask[:self.tiles[0], :self.tiles[1]]
+
+    def children(self, mask, level):
+        """ Per node mask of level - 1 from the mask of their parents """
+        (x, y) = self.box_min[level - 1].shape[:2]
+        return np.repeat(np.repeat(mask, 2, axis=0), 2, axis=1)[:x, :y]
+
+    def shrink(self, mask, level):
+        """ Per node mask of a level, True if any tile of the node is """
+        for _ in range(level):
+            mask = pairReduce(np.logical_or, mask)
+        return mask
+
+    def tile_levels(self, drawn):
+        """ Level of the node drawn over each tile """
+        levels = np.zeros(self.tiles, int)
+        for level, mask in enumerate(drawn):
+            levels[self.expand(mask, level)] = level
+        return levels
+
+    def select(self, camera=None, lod_distance=None):
+        """ Nodes covering the grid once, as per level (a, b, edge levels)
+            arrays: node (level, a[n], b[n]) and the levels of its 4 borders
+            (i=0, i=x-1, j=0, j=y-1) in its own vertices (0 all, 1 one out of
+            2). A node is split while lodLevels of the distance from camera (in
+            the grid space) to its box is under its level, and neighbour nodes
+            differ by one level at most. Without lod, all the tiles """
+        if camera is None or not lod_distance:
+            drawn = [np.ones(self.tiles, bool)] + [np.zeros(box.shape[:2], bool) for box in self.box_min[1:]]
+        else:
+            camera = np.asarray(camera, np.float32)[:3]
+            wanted = [lodLevels(np.linalg.norm(np.maximum(low - camera, 0) + np.maximum(camera - high, 0), axis=-1),
+                                lod_distance, self.depth) for low, high in zip(self.box_min, self.box_max)]
+            # wanted levels only grow from a node to its children: drawn at
+            # the first level down from the root where a node is fine enough
+            drawn = [wanted[level] >= level for level in range(self.depth + 1)]
+            for level in range(self.depth):
+                drawn[level] &= self.children(wanted[level + 1] < level + 1, level + 1)
+
+            # split the nodes more than one level coarser than a neighbour
+            while True:
+                levels = self.tile_levels(drawn)
+                padded = np.pad(levels, 1, mode='edge')
+                finest = np.minimum.reduce((padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]))
+                too_coarse = levels > finest + 1
+                if not too_coarse.any():
+                    break
+                for level in range(1, self.depth + 1):
+                    split = drawn[level] & self.shrink(too_coarse & (levels == level), level)
+                    drawn[level] &= ~split
+                    drawn[level - 1] |= self.children(split, level)
+
+        # border levels: a coarser neighbour covers the whole side, its first tile tells
+        padded = np.pad(self.tile_levels(drawn), 1, constant_values=-1)
+        selection = []
+        for level, mask in enumerate(drawn):
+            a, b = np.nonzero(mask)
+            (i0, j0), step = (a * 2 ** level + 1, b * 2 ** level + 1), 2 ** level
+            (i1, j1) = (np.minimum(i0 + step, len(padded) - 1), np.minimum(j0 + step, padded.shape[1] - 1))
+            sides = np.stack((padded[i0 - 1, j0], padded[i1, j0], padded[i0, j0 - 1], padded[i0, j1]), axis=-1)
+            selection.append((a, b, np.maximum(sides - level, 0)))
+        return selection
+
+
+class TerrainChunks:
+    """ Grid mesh split in square tiles, each with its own vertex array and
+        bounding box; only the tiles intersecting the view frustum are drawn.
+        With lod_distance, far tiles are merged in quadtree nodes keeping one
+        vertex out of 2, 4, ... (see TerrainQuadtree) """
+
+    def __init__(self, shader, attributes, size, chunk_size=32, lod_distance=None, **uniforms):
+        """ attributes hold one row per grid vertex, size is the (x, y) grid """
+        self.shader = shader
+        self.uniforms = uniforms
+        self.lod_distance = lod_distance
+        (x, y) = size
+        grid = {name: np.asarray(data).reshape(x, y, -1) for name, data in attributes.items()}
+        self.quadtree = TerrainQuadtree(grid['position'], chunk_size)
+        self.vertex_arrays, self.shapes = {}, {}  # (level, a, b) -> VertexArray, (vertex rows, columns)
+        levels = range(self.quadtree.depth + 1) if lod_distance else [0]
+        for level in levels:
+            for a, b in np.ndindex(self.quadtree.box_min[level].shape[:2]):
+                # nodes overlap by one row and column to share their borders
+                rows, columns = self.quadtree.samples(level, a, b)
+                node = {name: data[np.ix_(rows, columns)].reshape(len(rows) * len(columns), -1)
+                        for name, data in grid.items()}
+                self.vertex_arrays[level, a, b] = VertexArray(shader, node)
+                self.shapes[level, a, b] = (len(rows), len(columns))
+        self.index_buffers = {}  # (node_x, node_y, 0, edge levels) -> IndexBuffer
+        self.culled = 0  # number of nodes culled during the last draw
+
+    def index_buffer(self, node, edge_levels):
+        """ Shared index buffer of a node shape & border levels, built on first use """
+        key = (*self.shapes[node], 0, tuple(int(edge) for edge in edge_levels))
+        if key not in self.index_buffers:
+            self.index_buffers[key] = IndexBuffer(lodIndex(*key))
+        return self.index_buffers[key]
 
+    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+        uniforms = {**self.uniforms, **uniforms}
+        model = uniforms['model']
+        planes = frustum_planes(uniforms['projection'] @ uniforms['view'] @ model)
+        camera = uniforms.get('w_camera_position')
+        if camera is not None:  # into the grid space of the node boxes
+            camera = (np.linalg.inv(model) @ np.append(np.asarray(camera, np.float64)[:3], 1))[:3]
+        selection = self.quadtree.select(camera, self.lod_distance)
+
+        gl_state.use_program(self.shader.glid)
+        self.shader.set_uniforms(uniforms)
+        drawn = 0
+        for level, (a, b, edges) in enumerate(selection):
+            visible = boxes_in_frustum(planes, self.quadtree.box_min[level][a, b], self.quadtree.box_max[level][a, b])
+            for n in np.flatnonzero(visible):
+                node = (level, a[n], b[n])
+                index = self.index_buffer(node, edges[n])
+                self.vertex_arrays[node].execute(primitives, index=index)
+                frame_stats.count('terrain triangles', index.size // 3)
+            drawn += np.count_nonzero(visible)
+        self.culled = sum(len(a) for a, _, _ in selection) - drawn
+        frame_stats.count('terrain tiles culled', self.culled)
+        frame_stats.count('terrain tiles drawn', drawn)
+
+
+def sphereMesh(r=1, stacks=10, sectors=10):
+    """ Vertices, texture coordinates and index of a sphere centered on the origin """
+    # avec l'aide de : http://www.songho.ca/opengl/gl_sphere.html
+    vertices = ()
+    tex_coord = ()
 
-class TexturedSphere(Textured):
-    """ Procedural textured sphere """
+    sectorStep = 2 * np.pi / sectors
+    stackStep = np.pi / stacks
 
-    # avec l'aide de : http://www.songho.ca/opengl/gl_sphere.html
-    def __init__(self, shader, texture, position=(0, 0, 0), r=1, stacks=10, sectors=10, light_dir=None, shinyness=2):
-        # setup plane mesh to be textured
-        vertices = ()
-        tex_coord = ()
-
-        lengthInv = 1.0 / r
-        sectorStep = 2 * np.pi / sectors
-        stackStep = np.pi / stacks
-
-        for i in range(stacks + 1):
-            stackAngle = np.pi / 2 - i * stackStep
-            xy = r * np.cos(stackAngle)
-            z = r * np.sin(stackAngle)
-
-            for j in range(sectors + 1):
-                sectorAngle = j * sectorStep
-                # vertex position (x, y, z)
-                x = xy * np.cos(sectorAngle)
-                y = xy * np.sin(sectorAngle)
-                vertices = vertices + ((x, z, y),)
-                tex_coord += ((i / stacks, j / sectors),)
-        vertices = np.array(vertices, np.float32) + np.array(position, np.float32)
+    for i in range(stacks + 1):
+        stackAngle = np.pi / 2 - i * stackStep
+        xy = r * np.cos(stackAngle)
+        z = r * np.sin(stackAngle)
+
+        for j in range(sectors + 1):
+            sectorAngle = j * sectorStep
+            # vertex position (x, y, z)
+            x = xy * np.cos(sectorAngle)
+            y = xy * np.sin(sectorAngle)
+            vertices = vertices + ((x, z, y),)
+            tex_coord += ((i / stacks, j / sectors),)
+
+    index = ()
+    for i in range(stacks):
+        k1 = i * (sectors + 1)
+        k2 = k1 + sectors + 1
+        for j in range(sectors):
+
+            # 2 triangles per sector excluding first and last stacks
+            if (i != 0):
+                index = index + (k1, k1 + 1, k2)
+
+            if (i != (stacks - 1)):
+                index = index + (k1 + 1, k2 + 1, k2)
 
-        index = ()
-        for i in range(stacks):
-            k1 = i * (sectors + 1)
-            k2 = k1 + sectors + 1
-            for j in range(sectors):
+            k1 = k1 + 1
+            k2 = k2 + 1
+    return np.array(vertices, np.float32), np.array(tex_coord, np.float32), np.array(index, np.uint32)
 
-                # 2 triangles per sector excluding first and last stacks
-                if (i != 0):
-                    index = index + (k1, k1 + 1, k2)
 
-                if (i != (stacks - 1)):
-                    index = index + (k1 + 1, k2 + 1, k2)
+class TexturedSphere(Textured):
+    """ Procedural textured sphere """
 
-                k1 = k1 + 1
-                k2 = k2 + 1
+    def __init__(self, shader, texture, position=(0, 0, 0), r=1, stacks=10, sectors=10, light_dir=None, shinyness=2,
+                 keep_attributes=False):
+        # setup plane mesh to be textured
+        (vertices, tex_coord, index) = sphereMesh(r, stacks, sectors)
+        vertices = vertices + np.array(position, np.float32)
 
         (normals, vertices, index) = calcNormals(vertices, index)
         self.vertices = vertices
-        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=np.array(tex_coord), normal=normals),
-                    index=index, s=shinyness, light_dir=light_dir)
+        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=tex_coord, normal=normals),
+                    index=index, keep_attributes=keep_attributes, s=shinyness, light_dir=light_dir)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
         super().__init__(mesh, diffuse_map=texture)
@@ -64,25 +326,14 @@ class TexturedSphere(Textured):
 class Terrain(Textured):
     """ Procedural textured terrain """
 
-    def __init__(self, shader, texture, size=(100, 100), position=(0, -1, 0), light_dir=None, shinyness=2):
-        (x, y) = size
-        self.heightMap = np.random.random(size)
+    def __init__(self, shader, texture, size=(100, 100), position=(0, -1, 0), light_dir=None, shinyness=2, rng=None):
+        """ rng: numpy Generator or seed of the heightmap """
+        self.heightMap = np.random.default_rng(rng).random(size)
         # setup plane mesh to be textured
-        vertices = ()
-        tex_coord = ()
-        for i in range(x):
-            for j in range(y):
-                vertices = vertices + ((i - x / 2, self.heightMap[i][j] / 2, j - y / 2),)
-                tex_coord += ((i % 2, j % 2),)
-        vertices = np.array(vertices, np.float32) + np.array(position, np.float32)
-
-        index = ()
-        for k in range(y, x * y - 1):
-            if ((k + 1) % y != 0):
-                index = index + (k, k + 1 - y, k + 1, k, k - y, k + 1 - y)
+        (vertices, tex_coord, index) = gridMesh(self.heightMap, 0.5, position)
 
         (normals, vertices, index) = calcNormals(vertices, index)
-        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=np.array(tex_coord), normal=normals),
+        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=tex_coord, normal=normals),
                     index=index, s=shinyness, light_dir=light_dir)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
@@ -107,89 +358,165 @@ class TexturedPlane(Textured):
         super().__init__(mesh, diffuse_map=texture)
 
 
+def cylinderMesh(height=1, divisions=50, r=0.5):
+    """ Vertices, texture coordinates and index of a closed vertical cylinder
+        centered on the origin """
+    vertices = ()
+    tex_coord = ()
+    vertices = vertices + ((0, height / 2, 0),)
+    tex_coord += ((0, 0),)
+    tex_i = 0
+    for x in np.arange(0, 2 * np.pi, 2 * np.pi / divisions):
+        vertices = vertices + ((r * np.cos(x), height / 2, r * np.sin(x)),)
+        tex_coord += ((tex_i / divisions, 0),)
+        tex_i += 1
+    vertices = vertices + ((0, -height / 2, 0),)
+    tex_coord += ((1, 1),)
+    tex_i = 0
+    for x in np.arange(0, 2 * np.pi, 2 * np.pi / divisions):
+        vertices = vertices + ((r * np.cos(x), -height / 2, r * np.sin(x)),)
+        tex_coord += ((tex_i / divisions, 1),)
+        tex_i += 1
+
+    index = ()
+    # top face
+    for x in range(1, divisions, 1):
+        index = index + (0, x + 1, x)
+    index = index + (0, 1, divisions)
+    # bottom face
+    for x in range(1, divisions, 1):
+        index = index + (divisions + 1, divisions + x + 1, divisions + x + 2)
+    index = index + (divisions + 1, divisions * 2 + 1, divisions + 2)
+    # side
+    for x in range(1, divisions, 1):
+        index = index + (x, x + 1, divisions + x + 1, x + 1, divisions + x + 2, divisions + x + 1)
+    index = index + (divisions, 1, divisions * 2 + 1, 1, divisions + 2, divisions * 2 + 1)
+    return np.array(vertices, np.float32), np.array(tex_coord, np.float32), np.array(index, np.uint32)
+
+
 class TexturedCylinder(Textured):
     """ Simple first textured object """
 
-    def __init__(self, shader, texture, height=1, divisions=50, r=0.5, position=(0, 0, 0), light_dir=None, shinyness=2):
+    def __init__(self, shader, texture, height=1, divisions=50, r=0.5, position=(0, 0, 0), light_dir=None, shinyness=2,
+                 keep_attributes=False):
         self.height = height
         self.divisions = divisions
         self.ray = r
 
         # setup plane mesh to be textured
-        vertices = ()
-        tex_coord = ()
-        vertices = vertices + ((0, self.height / 2, 0),)
-        tex_coord += ((0, 0),)
-        tex_i = 0
-        for x in np.arange(0, 2 * np.pi, 2 * np.pi / self.divisions):
-            vertices = vertices + ((self.ray * np.cos(x), self.height / 2, self.ray * np.sin(x)),)
-            tex_coord += ((tex_i / divisions, 0),)
-            tex_i += 1
-        vertices = vertices + ((0, -self.height / 2, 0),)
-        tex_coord += ((1, 1),)
-        tex_i = 0
-        for x in np.arange(0, 2 * np.pi, 2 * np.pi / self.divisions):
-            vertices = vertices + ((self.ray * np.cos(x), -self.height / 2, self.ray * np.sin(x)),)
-            tex_coord += ((tex_i / divisions, 1),)
-            tex_i += 1
-        vertices = np.array(vertices, np.float32) + np.array(position, np.float32)
-
-        index = ()
-        # top face
-        for x in range(1, self.divisions, 1):
-            index = index + (0, x + 1, x)
-        index = index + (0, 1, self.divisions)
-        # bottom face
-        for x in range(1, self.divisions, 1):
-            index = index + (self.divisions + 1, self.divisions + x + 1, self.divisions + x + 2)
-        index = index + (self.divisions + 1, self.divisions * 2 + 1, self.divisions + 2)
-        # side
-        for x in range(1, self.divisions, 1):
-            index = index + (x, x + 1, self.divisions + x + 1, x + 1, self.divisions + x + 2, self.divisions + x + 1)
-        index = index + (self.divisions, 1, self.divisions * 2 + 1, 1, self.divisions + 2, self.divisions * 2 + 1)
+        (vertices, tex_coord, index) = cylinderMesh(height, divisions, r)
+        vertices = vertices + np.array(position, np.float32)
 
         (normals, vertices, index) = calcNormals(vertices, index)
-        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=np.array(tex_coord), normal=normals),
-                    index=index, s=shinyness, light_dir=light_dir)
+        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=tex_coord, normal=normals),
+                    index=index, keep_attributes=keep_attributes, s=shinyness, light_dir=light_dir)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
         super().__init__(mesh, diffuse_map=texture)
 
 
+class InstancedProps(Textured):
+    """ Copies of one textured mesh, each placed by its own 4x4 transform
+        stored in an instance buffer, drawn with a single instanced call
+        (see Shaders/instanced.vert) """
+
+    def __init__(self, shader, texture, mesh, transforms, light_dir=None, shinyness=2):
+        (vertices, tex_coord, index) = mesh
+        (normals, vertices, index) = calcNormals(vertices, index)
+        transforms = np.asarray(transforms, np.float32).reshape(-1, 4, 4)
+        instances = {'instance_column%d' % i: np.ascontiguousarray(transforms[:, :, i])
+                     for i in range(4)}
+        mesh = Mesh(shader, attributes=dict(position=vertices, tex_coord=tex_coord, normal=normals),
+                    index=index, instances=instances, s=shinyness, light_dir=light_dir)
+        super().__init__(mesh, diffuse_map=texture)
+
+
+def propTransforms(positions, scales):
+    """ (N,4,4) transforms translating then scaling a unit prop, from (N,3)
+        positions and (N,) uniform or (N,3) per axis scales """
+    positions = np.asarray(positions, np.float32).reshape(-1, 3)
+    scales = np.broadcast_to(np.asarray(scales, np.float32).reshape(len(positions), -1), positions.shape)
+    transforms = np.zeros((len(positions), 4, 4), np.float32)
+    transforms[:, [0, 1, 2], [0, 1, 2]] = scales
+    transforms[:, :3, 3] = positions
+    transforms[:, 3, 3] = 1
+    return transforms
+
+
 class TexturedTree(Node):
-    def __init__(self, shader, shaderLeaf, position, leavesTextures, trunkTextures, viewer, leafTexture,
-                 light_dir=None):
+    def __init__(self, shader, leaves, position, leavesTextures, trunkTextures, light_dir=None, rng=None):
+        """ leaves is the ParticleSystem receiving the leaves of this tree,
+            rng the numpy Generator or seed drawing its shape. Its meshes are
+            uploaded on first draw, never if a StaticBatch merges them """
         super().__init__()
-        random.seed()
+        rng = np.random.default_rng(rng)
 
         (x, z, y) = position
-        trunk_height = 5 + random.random()
-        main_leaves_size = 2 + random.random()
+        trunk_height = 5 + rng.random()
+        main_leaves_size = 2 + rng.random()
 
         self.add(
             TexturedCylinder(shader, position=(x, z + trunk_height / 2, y), height=trunk_height, texture=trunkTextures,
-                             light_dir=light_dir))
+                             light_dir=light_dir, keep_attributes=True))
         mainLeaves = TexturedSphere(shader, position=(x, z + trunk_height, y), r=main_leaves_size,
                                     texture=leavesTextures,
-                                    light_dir=light_dir)
-        self.add(FallingLeaves(viewer, shaderLeaf, light_dir, trunk_height - 0.5, leafTexture, (x, z + trunk_height, y),
-                               ray=main_leaves_size))
+                                    light_dir=light_dir, keep_attributes=True)
+        leaves.addLeaves(trunk_height - 0.5, (x, z + trunk_height, y), ray=main_leaves_size, rng=rng)
         self.add(mainLeaves)
         mainLeavesVertices = mainLeaves.vertices
-        for i in range(random.randint(0, 3)):
-            [x_, z_, y_] = mainLeavesVertices[random.randint(0, len(mainLeavesVertices) - 1)]
-            r = random.random()
+        for i in range(rng.integers(0, 4)):
+            [x_, z_, y_] = mainLeavesVertices[rng.integers(0, len(mainLeavesVertices))]
+            r = rng.random()
             self.add(
                 TexturedSphere(shader, position=(x_, z_, y_), r=r, texture=leavesTextures,
-                               light_dir=light_dir))
-            self.add(FallingLeaves(viewer, shaderLeaf, light_dir, z_ - z - 0.5, leafTexture, (x_, z_, y_), ray=r))
+                               light_dir=light_dir, keep_attributes=True))
+            leaves.addLeaves(z_ - z - 0.5, (x_, z_, y_), ray=r, rng=rng)
+
+
+class Forest(Node):
+    """ Trees like TexturedTree, but all trunks and all foliage spheres are
+        instances of one unit cylinder and one unit sphere: two draw calls
+        for any number of trees """
+
+    def __init__(self, shader, leaves, positions, leavesTextures, trunkTextures, light_dir=None, rng=None):
+        """ leaves is the ParticleSystem receiving the leaves of the trees,
+            rng the numpy Generator or seed drawing their shapes """
+        super().__init__()
+        positions = np.asarray(positions, np.float32).reshape(-1, 3)
+        count = len(positions)
+        if count == 0:
+            return
+        rng = np.random.default_rng(rng)
+        trunk_heights = 5 + rng.random(count)
+        main_leaves_sizes = 2 + rng.random(count)
+        tops = positions + np.outer(trunk_heights, (0, 1, 0))
+        trunks = propTransforms(tops - np.outer(trunk_heights / 2, (0, 1, 0)),
+                                np.stack((np.ones(count), trunk_heights, np.ones(count)), axis=-1))
+
+        # main foliage on top of the trunk, then 0 to 3 smaller spheres
+        # centered on random vertices of the main one
+        sphere = sphereMesh()
+        owners = np.repeat(np.arange(count), rng.integers(0, 4, count))
+        around = sphere[0][rng.integers(0, len(sphere[0]), len(owners))]
+        centers = np.concatenate((tops, tops[owners] + around * main_leaves_sizes[owners, None]))
+        radii = np.concatenate((main_leaves_sizes, rng.random(len(owners))))
+        fall_heights = centers[:, 1] - np.concatenate((positions, positions[owners]))[:, 1] - 0.5
+        leaves.addLeavesFrom(fall_heights, centers, radii, rng)
+
+        self.add(InstancedProps(shader, trunkTextures, cylinderMesh(), trunks, light_dir=light_dir),
+                 InstancedProps(shader, leavesTextures, sphere, propTransforms(centers, radii),
+                                light_dir=light_dir))
 
 
 class TexturedCube(Textured):
+    depth_func = GL.GL_LEQUAL
+
     def __init__(self, drawable, **textures):
         super().__init__(drawable, **textures)
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+    def draw(self, primitives=GL.GL_TRIANGLES, queue=None, **uniforms):
+        if queue is not None:
+            return super().draw(primitives, queue, **uniforms)
         GL.glDepthFunc(GL.GL_LEQUAL)
         for index, (name, texture) in enumerate(self.textures.items()):
             GL.glActiveTexture(GL.GL_TEXTURE0 + index)
@@ -201,11 +528,6 @@ class TexturedCube(Textured):
         GL.glDepthFunc(GL.GL_LESS)
 
 
-def nerbyPoints(point):
-    (x, y) = point
-    return [(x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)]
-
-
 class TexturedPlaneWater(KeyFrameControlNode):
     def __init__(self, shader, light_dir, texture, position=(0, 0, 0), shinyness=2, scale=1,
                  repeat=True, animationShift=0, minx=0, maxx=1, miny=0, maxy=1):
@@ -236,7 +558,7 @@ class TexturedDuck(KeyFrameControlNode):
                     8: quaternion_from_euler(0, 0, 270)}
         scale_keys = {0: 0.05, 8: 0.05}
         super().__init__(trans_keys, rot_keys, scale_keys, repeat=repeat, animationShift=animationShift)
-        self.add(*load('Objects/duck/10602_Rubber_Duck_v1_L3.obj', shader, texture, light_dir=light_dir))
+        self.add(*assets.load('Objects/duck/10602_Rubber_Duck_v1_L3.obj', shader, texture, light_dir=light_dir))
 
 
 class TexturedLava(KeyFrameControlNode):
@@ -257,14 +579,31 @@ class TexturedVolcano(KeyFrameControlNode):
         rot_keys = {0: quaternion_from_euler(0, 0, 0), 4: quaternion_from_euler(0, 180, 0)}
         scale_keys = {0: 6, 1: 6}
         super().__init__(trans_keys, rot_keys, scale_keys, repeat=repeat, animationShift=animationShift)
-        self.add(*load('Objects/volcano/volcano.obj', shader, texture, light_dir=light_dir))
+        self.add(*assets.load('Objects/volcano/volcano.obj', shader, texture, light_dir=light_dir))
         self.add(TexturedLava(shader, lava_texture, duck_tex_file, light_dir))
 
 
+def randomDraws(rng=None):
+    """ Endless random.randint(0, 100) values: from the random module, or
+        drawn by blocks from rng, a numpy Generator """
+    if rng is None:
+        getrandbits = random.getrandbits  # random.randint(0, 100) draws 7 bits until <= 100
+        while True:
+            draw = getrandbits(7)
+            if draw <= 100:
+                yield draw
+    while True:
+        yield from rng.integers(0, 101, 4096).tolist()
+
+
 class Lake(KeyFrameControlNode):
-    def __init__(self, shader, terrainSize, waterTexture, light_dir, position=None, depth=4):
+    def __init__(self, shader, terrainSize, waterTexture, light_dir, position=None, depth=4, expandchance=50,
+                 rng=None):
+        """ rng: numpy Generator drawing the lake, else the random module is used """
         (x, y) = terrainSize
-        if position == None:
+        if position is None and rng is not None:
+            (centerx, centery) = (rng.integers(0, x + 1), rng.integers(0, y + 1))
+        elif position is None:
             (centerx, centery) = (random.randint(0, x), random.randint(0, y))
         else:
             (centerx, centery) = position
@@ -273,53 +612,55 @@ class Lake(KeyFrameControlNode):
         self.shader = shader
         self.light_dir = light_dir
         # ------------ creating lake -----------------
-        lakePoints = ()
-        toProcess = [(centerx, centery)]
-        expandchance = 50  # % of chance for each vertex to expand to one direction
-        while len(toProcess) != 0:
-            (x_, y_) = toProcess.pop(0)
-            for element in nerbyPoints((x_, y_)):
-                (a, b) = element
-                if lakePoints.count(element) == 0 and toProcess.count(element) == 0:
-                    if (a >= 1 and a < x - 1 and b >= 1 and b < y - 1):  # don't take vertices on the edges
-                        if (random.randint(0, 100) < expandchance):
-                            toProcess.append(element)
-                            for e in nerbyPoints(element):  # traitement des pics résiduels
-                                [e1, e2, e3, e4] = nerbyPoints(e)
-                                if (lakePoints.count(e1) + lakePoints.count(e2) + lakePoints.count(
-                                        e3) + lakePoints.count(e4)):
-                                    lakePoints += (e,)
-            lakePoints += ((x_, y_),)
-        self.lakeDepths = lakePoints
-        waterVertex = ()
-        for element in lakePoints:
-            (elx, ely) = element
-            waterVertex += ((elx, ely),)
-            for e in nerbyPoints(element):
-                if lakePoints.count(e) == 0 and waterVertex.count(e) == 0:
-                    (ex, ey) = e
-                    waterVertex += ((ex, ey),)
-        waterVertex = np.array(waterVertex, np.float32)
+        # points are flat indices in a grid with a margin of one cell around the terrain, the lake
+        # center can be on its edges; lake and queued points are flagged in bytearrays, not searched
+        width = y + 3
+        inside = np.zeros((x + 3, width), np.uint8)
+        inside[2:x, 2:y] = 1  # don't take vertices on the edges
+        inside = bytearray(inside.tobytes())
+        lake, queued = bytearray(len(inside)), bytearray(len(inside))
+        lakePoints = []  # expandchance: % of chance for each vertex to expand to one direction
+        toProcess = deque([(centerx + 1) * width + centery + 1])
+        queued[toProcess[0]] = 1
+        draws = randomDraws(rng)
+        while toProcess:
+            point = toProcess.popleft()
+            queued[point] = 0
+            for element in (point + width, point - width, point + 1, point - 1):
+                if not lake[element] and not queued[element] and inside[element]:
+                    if next(draws) < expandchance:
+                        toProcess.append(element)
+                        queued[element] = 1
+                        for e in (element + width, element - width, element + 1, element - 1):  # pics résiduels
+                            if lake[e + width] or lake[e - width] or lake[e + 1] or lake[e - 1]:
+                                lakePoints.append(e)
+                                lake[e] = 1
+            lakePoints.append(point)
+            lake[point] = 1
+        lakePoints = np.array(lakePoints, np.int64)
+        self.lakeDepths = np.stack(np.divmod(lakePoints, width), axis=-1) - 1  # with repeated points
+
+        # water vertices: the lake and its ring of 4-neighbours
+        lake = np.frombuffer(lake, np.uint8).reshape(-1, width).astype(bool)
+        ring = np.zeros_like(lake)
+        ring[1:] |= lake[:-1]
+        ring[:-1] |= lake[1:]
+        ring[:, 1:] |= lake[:, :-1]
+        ring[:, :-1] |= lake[:, 1:]
+        ring &= ~lake
+        waterVertex = np.concatenate((self.lakeDepths, np.argwhere(ring) - 1)).astype(np.float32)
         self.lake = waterVertex
-        minx = waterVertex[0][0]
-        miny = waterVertex[0][1]
-        maxx = waterVertex[0][0]
-        maxy = waterVertex[0][1]
-        for element in waterVertex:
-            if (element[0] > maxx):
-                maxx = element[0]
-            if (element[0] < minx):
-                minx = element[0]
-            if (element[1] > maxy):
-                maxy = element[1]
-            if (element[1] < miny):
-                miny = element[1]
+        (minx, miny), (maxx, maxy) = np.min(waterVertex, axis=0), np.max(waterVertex, axis=0)
         self.extremums = (minx - x / 2, maxx - x / 2, miny - y / 2, maxy - y / 2)
 
+    def dig(self, heightmap):
+        """ Lowers the lake points of heightmap, in place """
+        (x_, y_) = self.lakeDepths.T
+        np.subtract.at(heightmap, (x_ - 1, y_ - 1), self.depth)  # once per repeated point
+
     def addTo(self, terrain):
         """Adds this lake to the given terrain and returns the water layer Texture"""
-        for (x_, y_) in self.lakeDepths:
-            terrain.heightMap[x_ - 1][y_ - 1] -= self.depth
+        self.dig(terrain.heightMap)
         (minx, maxx, miny, maxy) = self.extremums
         (x, z, y) = terrain.position
         # Nouvelle classe
@@ -328,12 +669,23 @@ class Lake(KeyFrameControlNode):
 
 
 class LakeTerrain(Textured):
+    height_scale = 0.8
+
     def __init__(self, shader, textureTerrain, textureWater, size=(100, 100), position=(0, -1, 0), light_dir=None,
-                 shinyness=2, depth=4, heightmap=None, lakes=2):
-        if (heightmap == None):
-            self.heightMap = np.random.random(size)
+                 shinyness=2, depth=4, heightmap=None, lakes=2, chunk_size=None, lod_distance=None, rng=None,
+                 world=None):
+        """ rng: numpy Generator or seed of the heightmap and lakes; lakes are
+            drawn with the random module without it. A given heightmap sets
+            the size. world: a world.World whose heightmap, lakes, water mask
+            and normals are used as they are """
+        if world is not None:
+            heightmap = world.heightmap
+        rng = None if rng is None else np.random.default_rng(rng)
+        if heightmap is None:
+            self.heightMap = np.random.default_rng(rng).random(size)
         else:
             self.heightMap = heightmap
+            size = np.shape(heightmap)  # lakes are grown and placed on its grid
         self.position = position
         self.size = size
         self.textureWater = textureWater
@@ -343,69 +695,87 @@ class LakeTerrain(Textured):
         self.shinyness = shinyness
         self.lakes = []
         self.waters = []
-        for i in range(lakes):
-            lake = Lake(self.shader, self.size, self.textureWater, self.light_dir, depth=self.depth)
-            self.lakes.append(lake)
-            self.waters.append(lake.addTo(self))
+        if world is not None:  # lakes already dug
+            self.waters = [TexturedPlaneWater(shader=self.shader, light_dir=self.light_dir, texture=self.textureWater,
+                                              minx=minx, maxx=maxx, miny=miny, maxy=maxy)
+                           for (minx, maxx, miny, maxy) in world.lakes]
+            self.water = world.water
+        else:
+            for i in range(lakes):
+                lake = Lake(self.shader, self.size, self.textureWater, self.light_dir, depth=self.depth, rng=rng)
+                self.lakes.append(lake)
+                self.waters.append(lake.addTo(self))
+            self.water = waterMask(np.shape(self.heightMap), self.lakes)  # land/water mask over the grid
+        self.grass = np.flatnonzero(~self.water)  # indices of the terrain vertices out of the lakes
 
         # ------------------ creating terrain ------------------
-        (x, y) = self.size
-        vertices = np.zeros((x * y, 3), np.float32)
-        tex_coord = np.zeros((x * y, 2), np.float32)
-        for i in range(x):
-            for j in range(y):
-                vertices[y * i + j] = [i - x / 2, self.heightMap[i][j] * 0.8, j - y / 2]
-                tex_coord[y * i + j] = [i % 2, j % 2]
-        vertices = vertices + np.array(self.position, np.float32)
-        index = np.zeros((6 * (x * y - 1 - y)), np.float32)
-        i = 0
-        for k in range(y, x * y - 1):
-            if ((k + 1) % y != 0):
-                index[i] = k
-                index[i + 1] = k + 1 - y
-                index[i + 2] = k + 1
-                index[i + 3] = k
-                index[i + 4] = k - y
-                index[i + 5] = k + 1 - y
-                i += 6
-        (normals, vertices, index) = calcNormals(vertices, index)
+        (vertices, tex_coord, index) = gridMesh(self.heightMap, self.height_scale, self.position)
+        if world is not None and world.normals is not None:  # computed by tiles with the world
+            normals = world.normals.reshape(-1, 3)
+        else:
+            (normals, vertices, index) = calcNormals(vertices, index)
         self.vertices = vertices
-        mesh = Mesh(self.shader, attributes=dict(position=vertices, tex_coord=tex_coord, normal=normals),
-                    index=index, s=self.shinyness, light_dir=self.light_dir)
+        attributes = dict(position=vertices, tex_coord=tex_coord, normal=normals)
+        if chunk_size:
+            mesh = TerrainChunks(self.shader, attributes, self.heightMap.shape, chunk_size, lod_distance,
+                                 s=self.shinyness, light_dir=self.light_dir)
+        else:
+            mesh = Mesh(self.shader, attributes=attributes, index=index, s=self.shinyness, light_dir=self.light_dir)
 
         # setup & upload texture to GPU, bind it to shader name 'diffuse_map'
         super().__init__(mesh, diffuse_map=textureTerrain)
 
     def getRandomPointOnGrass(self):
-        [x, z, y] = self.vertices[random.randint(0, len(self.vertices) - 1)]
-        for i in range(len(self.lakes)):
-            while self.contains(self.lakes[i].lake, [x, z, y]):
-                [x, z, y] = self.vertices[random.randint(0, len(self.vertices) - 1)]
-                i = 0
-        return (x, z, y)
+        """ Random terrain vertex (x, z, y) out of the lakes """
+        return tuple(self.vertices[self.grass[random.randint(0, len(self.grass) - 1)]])
 
-    def contains(self, coordLake, element):
-        [a, b, c] = element
-        for [x, y] in coordLake:
-            if a == x and c == y:
-                return True
-        return False
+    def getRandomPointsOnGrass(self, k, rng=None):
+        """ (k, 3) random terrain vertices out of the lakes, drawn with replacement
+            using rng: a numpy Generator, a seed, or None for a fresh one """
+        return self.vertices[np.random.default_rng(rng).choice(self.grass, k)]
+
+    def onWater(self, point):
+        """ Whether the terrain vertex nearest to point (x, z, y) is in a lake """
+        (x, z, y) = point
+        (px, pz, py) = self.position
+        (sx, sy) = self.water.shape
+        (i, j) = (int(round(x + sx / 2 - px)), int(round(y + sy / 2 - py)))
+        return 0 <= i < sx and 0 <= j < sy and bool(self.water[i, j])
 
 
 class LakeForestTerrain(Node):
     def __init__(self, shader, shaderLeaf, terrainTexture, waterTextures, leavesTextures, trunkTextures, leafTexture,
-                 viewer, light_dir, size=(100, 100), position=(0, 0, 0)):
+                 viewer, light_dir, size=(100, 100), position=(0, 0, 0), chunk_size=None, lod_distance=None,
+                 trees=None, shaderProps=None, rng=None, world=None):
+        """ With shaderProps (Shaders/instanced.vert), trees are instanced
+            props and their number is not capped. rng (numpy Generator or
+            seed) draws the whole terrain. A world.World gives the terrain,
+            lakes and tree positions instead, and the generators of the trees """
         super().__init__()
+        rng = np.random.default_rng(rng)
+        if world is not None:
+            (size, position) = (tuple(world.params['size']), tuple(world.params['position']))
         terrain = LakeTerrain(shader=shader, size=size, textureTerrain=terrainTexture, textureWater=waterTextures,
-                              position=position, light_dir=light_dir)
+                              position=position, light_dir=light_dir, chunk_size=chunk_size,
+                              lod_distance=lod_distance, rng=rng, world=world)
         self.add(terrain)
         for water in terrain.waters:
             self.add(water)
         (length, width) = size
-        trees = min(10, random.randint(0, (length / 10) * (width / 10)))
-        for t in range(trees):
-            (posx, posy, posz) = terrain.getRandomPointOnGrass()
-            if -20 <= posx >= 20 or -20 <= posz >= 20:
-                self.add(TexturedTree(shader=shader, shaderLeaf=shaderLeaf, position=terrain.getRandomPointOnGrass(),
-                                      trunkTextures=trunkTextures, leavesTextures=leavesTextures, light_dir=light_dir,
-                                      viewer=viewer, leafTexture=leafTexture))
+        leaves = ParticleSystem(shaderLeaf, leafTexture)  # all falling leaves
+        if world is not None:
+            positions, rng = world.trees, world.rng('forest')
+        else:
+            count = rng.integers(0, length * width // 100 + 1) if trees is None else trees
+            positions = treePositions(terrain.vertices, terrain.grass, count, rng)
+        if trees is None and not shaderProps:
+            positions = positions[:10]
+        if shaderProps:
+            self.add(Forest(shaderProps, leaves, positions, leavesTextures, trunkTextures, light_dir, rng))
+        else:
+            forest = Node()
+            for position in positions:
+                forest.add(TexturedTree(shader=shader, leaves=leaves, position=position, trunkTextures=trunkTextures,
+                                        leavesTextures=leavesTextures, light_dir=light_dir, rng=rng))
+            self.add(StaticBatch(forest))  # trees never move: one draw per texture
+        self.add(leaves)
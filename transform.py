@@ -12,6 +12,9 @@ from numbers import Number  # useful to check type of arg: scalar or vector?
 import numpy as np          # matrices, vectors & quaternions are numpy arrays
 
 
+# Functions below also take stacks of N vectors or quaternions, as (N,3) or
+# (N,4) arrays, and then return (N,4,4) matrices, one per row.
+
 # Some useful functions on vectors -------------------------------------------
 def vec(*iterable):
     """ shortcut to make numpy vector of any iterable(tuple...) or vector """
@@ -19,9 +22,14 @@ def vec(*iterable):
 
 
 def normalized(vector):
-    """ normalized version of any vector, with zero division check """
-    norm = math.sqrt(sum(vector*vector))
-    return vector / norm if norm > 0. else vector
+    """ normalized version of any vector, or of each row of an (N,k) array,
+        with zero division check """
+    vector = np.asarray(vector)
+    if vector.ndim == 1:
+        norm = math.sqrt(np.dot(vector, vector))
+        return vector / norm if norm > 0. else vector
+    norm = np.sqrt(np.einsum('...i,...i->...', vector, vector))[..., None]
+    return vector / np.where(norm > 0., norm, 1.)
 
 
 def lerp(point_a, point_b, fraction):
@@ -72,17 +80,27 @@ def frustum(xmin, xmax, ymin, ymax, zmin, zmax):
 
 
 def translate(x=0.0, y=0.0, z=0.0):
-    """ matrix to translate from coordinates (x,y,z) or a vector x"""
-    matrix = np.identity(4, 'f')
-    matrix[:3, 3] = vec(x, y, z) if isinstance(x, Number) else vec(x)
+    """ matrix to translate from coordinates (x,y,z) or a vector x, or (N,4,4)
+        matrices from (N,3) vectors x """
+    offset = (x, y, z) if isinstance(x, Number) else np.asarray(x)
+    matrix = np.zeros(np.shape(offset)[:-1] + (4, 4), 'f')
+    matrix.reshape(-1, 16)[:, ::5] = 1
+    matrix[..., :3, 3] = offset
     return matrix
 
 
 def scale(x, y=None, z=None):
-    """scale matrix, with uniform (x alone) or per-dimension (x,y,z) factors"""
-    x, y, z = (x, y, z) if isinstance(x, Number) else (x[0], x[1], x[2])
-    y, z = (x, x) if y is None or z is None else (y, z)  # uniform scaling
-    return np.diag((x, y, z, 1))
+    """ scale matrix, with uniform (x alone) or per-dimension (x,y,z) factors,
+        or (N,4,4) matrices from (N,3) per-dimension or (N,1) uniform x """
+    if isinstance(x, Number) or np.ndim(x) < 2:
+        x, y, z = (x, y, z) if isinstance(x, Number) else (x[0], x[1], x[2])
+        y, z = (x, x) if y is None or z is None else (y, z)  # uniform scaling
+        return np.diag((x, y, z, 1))
+    factors = np.asarray(x, 'f')
+    matrix = np.zeros((len(factors), 4, 4), 'f')
+    matrix[:, (0, 1, 2), (0, 1, 2)] = factors.reshape(len(factors), -1)
+    matrix[:, 3, 3] = 1
+    return matrix
 
 
 def sincos(degrees=0.0, radians=None):
@@ -114,6 +132,27 @@ def lookat(eye, target, up):
     return rotation @ translate(-eye)
 
 
+# view frustum culling --------------------------------------------------------
+def frustum_planes(matrix):
+    """ 6 normalized clip planes (a,b,c,d) of a projection @ view @ model
+        matrix; a point p is inside when a*x + b*y + c*z + d >= 0 for all """
+    matrix = np.asarray(matrix, np.float64)
+    planes = np.array([matrix[3] + matrix[0], matrix[3] - matrix[0],   # l, r
+                       matrix[3] + matrix[1], matrix[3] - matrix[1],   # b, t
+                       matrix[3] + matrix[2], matrix[3] - matrix[2]])  # n, f
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def boxes_in_frustum(planes, box_min, box_max):
+    """ Boolean array telling which axis aligned boxes, given as (N,3) min and
+        max corners, are at least partially inside the frustum planes """
+    box_min, box_max = np.atleast_2d(box_min), np.atleast_2d(box_max)
+    # per box & plane, the corner furthest along the plane normal
+    corners = np.where(planes[:, :3] >= 0, box_max[:, None], box_min[:, None])
+    distances = np.einsum('npk,pk->np', corners, planes[:, :3]) + planes[:, 3]
+    return np.all(distances >= 0, axis=1)
+
+
 # quaternion functions -------------------------------------------------------
 def quaternion(x=vec(0., 0., 0.), y=0.0, z=0.0, w=1.0):
     """ Init quaternion, w=real and, x,y,z or vector x imaginary components """
@@ -138,39 +177,65 @@ def quaternion_from_euler(yaw=0.0, pitch=0.0, roll=0.0, radians=None):
 
 def quaternion_mul(q1, q2):
     """ Compute quaternion which composes rotations of two quaternions """
-    return np.dot(np.array([[q1[0], -q1[1], -q1[2], -q1[3]],
-                            [q1[1],  q1[0], -q1[3],  q1[2]],
-                            [q1[2],  q1[3],  q1[0], -q1[1]],
-                            [q1[3], -q1[2],  q1[1],  q1[0]]]), q2)
+    q1, q2 = np.asarray(q1), np.asarray(q2)
+    single = q1.ndim == q2.ndim == 1  # python floats are faster than 0-d arrays
+    w1, x1, y1, z1 = q1.tolist() if single else np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = q2.tolist() if single else np.moveaxis(q2, -1, 0)
+    q = (w1*w2 - x1*x2 - y1*y2 - z1*z2, x1*w2 + w1*x2 - z1*y2 + y1*z2,
+         y1*w2 + z1*x2 + w1*y2 - x1*z2, z1*w2 - y1*x2 + x1*y2 + w1*z2)
+    return np.array(q, np.result_type(q1, q2)) if single else np.stack(q, axis=-1)
 
 
 def quaternion_matrix(q):
     """ Create 4x4 rotation matrix from quaternion q """
     q = normalized(q)  # only unit quaternions are valid rotations.
-    nxx, nyy, nzz = -q[1]*q[1], -q[2]*q[2], -q[3]*q[3]
-    qwx, qwy, qwz = q[0]*q[1], q[0]*q[2], q[0]*q[3]
-    qxy, qxz, qyz = q[1]*q[2], q[1]*q[3], q[2]*q[3]
-    return np.array([[2*(nyy + nzz)+1, 2*(qxy - qwz),   2*(qxz + qwy),   0],
-                     [2 * (qxy + qwz), 2 * (nxx + nzz) + 1, 2 * (qyz - qwx), 0],
-                     [2 * (qxz - qwy), 2 * (qyz + qwx), 2 * (nxx + nyy) + 1, 0],
-                     [0, 0, 0, 1]], 'f')
+    w, x, y, z = q.tolist() if q.ndim == 1 else np.moveaxis(q, -1, 0)
+    rows = ((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)),
+            (2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)),
+            (2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)))
+    if q.ndim == 1:
+        return np.array([row + (0,) for row in rows] + [(0, 0, 0, 1)], 'f')
+    matrix = np.zeros(q.shape[:-1] + (4, 4), 'f')
+    matrix[..., :3, :3] = np.stack([np.stack(row, axis=-1) for row in rows], axis=-2)
+    matrix[..., 3, 3] = 1
+    return matrix
 
 
 def quaternion_slerp(q0, q1, fraction):
-    """ Spherical interpolation of two quaternions by 'fraction' """
+    """ Spherical interpolation of two quaternions by 'fraction', or of
+        (N,4) quaternions by a fraction or (N,) fractions """
     # only unit quaternions are valid rotations.
     q0, q1 = normalized(q0), normalized(q1)
-    dot = np.dot(q0, q1)
-
-    # if negative dot product, the quaternions have opposite handedness
-    # and slerp won't take the shorter path. Fix by reversing one quaternion.
-    q1, dot = (q1, dot) if dot > 0 else (-q1, -dot)
-
-    theta_0 = math.acos(np.clip(dot, -1, 1))  # angle between input vectors
-    theta = theta_0 * fraction                # angle between q0 and result
-    q2 = normalized(q1 - q0*dot)              # {q0, q2} now orthonormal basis
-
-    return q0*math.cos(theta) + q2*math.sin(theta)
+    if q0.ndim == q1.ndim == 1:
+        dot = float(np.dot(q0, q1))
+
+        # if negative dot product, the quaternions have opposite handedness
+        # and slerp won't take the shorter path. Fix by reversing one quaternion.
+        q1, dot = (q1, dot) if dot > 0 else (-q1, -dot)
+
+        theta_0 = math.acos(min(dot, 1.))  # angle between input vectors
+        theta = theta_0 * fraction         # angle between q0 and result
+        q2 = normalized(q1 - q0*dot)       # {q0, q2} now orthonormal basis
+        return q0*math.cos(theta) + q2*math.sin(theta)
+
+    # same steps for each row
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1, dot = np.where(dot > 0, q1, -q1), np.abs(dot)
+    fraction = np.asarray(fraction)
+    fraction = fraction[..., None] if fraction.ndim < dot.ndim else fraction
+    theta = np.arccos(np.minimum(dot, 1.)) * fraction
+    q2 = normalized(q1 - q0*dot)
+    return q0*np.cos(theta) + q2*np.sin(theta)
+
+
+def trs_matrix(translation, q, factors):
+    """ translate(translation) @ quaternion_matrix(q) @ scale(factors) without
+        the matrix products, for one transform or (N,3), (N,4), (N,3) stacks """
+    matrix, factors = quaternion_matrix(q), np.asarray(factors)
+    factors = factors[..., None] if factors.ndim < matrix.ndim - 1 else factors
+    matrix[..., :3, :3] *= factors[..., None, :]  # rotation @ scale scales columns
+    matrix[..., :3, 3] = translation
+    return matrix
 
 
 # a trackball class based on provided quaternion functions -------------------
@@ -3,6 +3,9 @@
 Python OpenGL practical application.
 """
 
+# Python built-in modules
+import sys  # world seed argument
+
 # External, non built-in modules
 import OpenGL.GL as GL
 import numpy as np  # all matrix manipulations & OpenGL args
@@ -11,7 +14,8 @@ import glfw  # lean window system wrapper for OpenGL
 from core import Shader, Mesh, Viewer, Node, load
 from skybox import SkyBox
 from textures import TexturedDuck, LakeForestTerrain, TexturedVolcano
-from texture import Texture
+from texture import texture_cache
+from world import load_world
 
 class Axis(Mesh):
     """ Axis object useful for debugging coordinate frames """
@@ -58,17 +62,16 @@ def main():
     shaderTexture = Shader("Shaders/texture.vert", "Shaders/texture.frag")
     shaderLight = Shader("Shaders/phong.vert", "Shaders/phong.frag")
     skyboxShader = Shader("Shaders/skybox.vert", "Shaders/skybox.frag")
+    particleShader = Shader("Shaders/particle.vert", "Shaders/particle.frag")
+    propShader = Shader("Shaders/instanced.vert", "Shaders/phong.frag")
     # shaderNormals = Shader("Shaders/normalviz.vert", "Shaders/normalviz.frag", "Shaders/normalviz.geom")
 
-    # Textures
-    trunk = Texture("Textures/tronc.jpg")
-    leaves = Texture("Textures/leaves.jpg")
-    leaf = Texture("Textures/leaf.png")
-    grass = Texture("Textures/grass.png")
-    water = Texture("Textures/water.jpg")
-    lava = Texture("Textures/lava.jpg")
+    # Textures, decoded in parallel; model textures are found in the cache later
     volcano_tex_file = "Objects/volcano/volcano_texture.png"
     duck_tex_file = "Objects/duck/10602_Rubber_Duck_v1_diffuse.jpg"
+    trunk, leaves, leaf, grass, water, lava, _, _ = texture_cache.load(
+        "Textures/tronc.jpg", "Textures/leaves.jpg", "Textures/leaf.png", "Textures/grass.png",
+        "Textures/water.jpg", "Textures/lava.jpg", volcano_tex_file, duck_tex_file)
 
     light_dir = (1, -1, 1)
 
@@ -77,10 +80,13 @@ def main():
     # Skybox
     viewer.add(SkyBox(skyboxShader, "Textures/skybox/"))
     # Terrain with node (Trees, Lakes, ...)
-    viewer.add(LakeForestTerrain(shaderLight, shaderTexture, grass, water, leaves, trunk, leaf, viewer, light_dir))
+    # python viewer.py [seed]: the same seed gives the same world, read from .cache/worlds after the first run
+    world = load_world(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    viewer.add(LakeForestTerrain(shaderLight, particleShader, grass, water, leaves, trunk, leaf, viewer, light_dir,
+                                 chunk_size=32, lod_distance=64, shaderProps=propShader, world=world))
 
     print("====Controls====\nLeft-click: rotate camera\nRight-click: move camera\nMouse wheel: Zoom/Dezoom\nZ: Show vertices\nSpace: Reset time to 0\n→ ← ↑ ↓: Translate view")
-    print("P/M: modify gamma correction\nO/L: modify fog distance\n")
+    print("P/M: modify gamma correction\nO/L: modify fog distance\nI: print last frame statistics\n")
     # start rendering loop
     viewer.run()
 
@@ -0,0 +1,262 @@
+"""
+Seeded, reproducible generation of the lake and forest world. Every stage
+draws from its own numpy Generator derived from one seed, and the result is a
+World: heightmap, normals, water mask, water planes and tree positions, all
+arrays, cached on disk by seed and parameters (see load_world).
+
+Large worlds are generated by square tiles: noise heightmap, normals and tree
+placement of every tile are independent jobs, run by a pool of processes
+writing their blocks of the arrays in shared memory (see TilePool). Lakes
+cross tiles and are dug in between, by the main process. The result does not
+depend on the number of workers.
+"""
+# Python built-in modules
+import hashlib              # cache file names
+import json                 # cache metadata
+import multiprocessing      # start method of the workers
+import os                   # cache directory, cpu count
+from concurrent.futures import ProcessPoolExecutor   # tile jobs
+from itertools import repeat                        # same arrays for all jobs
+from multiprocessing.shared_memory import SharedMemory  # arrays of the jobs
+
+# External, non built-in modules
+import numpy as np          # all generated arrays
+
+import noise
+from geometry import calcNormals, gridMesh, treePositions, waterMask
+
+# generated worlds are cached there, see load_world
+WORLD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '.cache', 'worlds')
+
+# part of the cache key, to bump whenever generation changes
+WORLD_VERSION = 2
+
+# one random stream per stage: a stage draws the same numbers whether the
+# stages before it were generated or read from the cache
+STAGES = ('heightmap', 'lakes', 'trees', 'forest')
+
+
+class World:
+    """ Description of a generated world, numpy arrays and json parameters """
+
+    def __init__(self, seed, params, heightmap=None, water=None, lakes=None, trees=None, normals=None):
+        self.seed = seed
+        self.params = params        # see world_params
+        self.heightmap = heightmap  # (x, y) heights, lakes dug
+        self.normals = normals      # (x, y, 3) float32 normals of the terrain vertices
+        self.water = water          # (x, y) bool, True for vertices under water
+        self.lakes = lakes          # (N, 4) minx, maxx, miny, maxy of each water plane
+        self.trees = trees          # (T, 3) tree positions (x, z, y)
+
+    def rng(self, stage):
+        """ numpy Generator of one of the STAGES of this world """
+        return np.random.default_rng([self.seed, STAGES.index(stage)])
+
+    def tile_rngs(self, stage, count):
+        """ count independent numpy Generators of a stage, one per tile """
+        sequence = np.random.SeedSequence([self.seed, STAGES.index(stage)])
+        return [np.random.default_rng(child) for child in sequence.spawn(count)]
+
+    def save(self, file):
+        """ Write as uncompressed npz: arrays + json metadata, atomically """
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        temporary = file + '.%d.tmp' % os.getpid()
+        with open(temporary, 'wb') as output:
+            np.savez(output, meta=np.array(json.dumps(dict(seed=self.seed, params=self.params))),
+                     heightmap=self.heightmap, water=self.water, lakes=self.lakes, trees=self.trees,
+                     normals=self.normals)
+        os.replace(temporary, file)  # atomic, never a half written cache
+
+    @staticmethod
+    def load(file):
+        """ Read back a world written by save """
+        with np.load(file) as data:
+            meta = json.loads(str(data['meta']))
+            return World(meta['seed'], meta['params'], data['heightmap'], data['water'],
+                         data['lakes'], data['trees'], data['normals'])
+
+
+def world_params(size=(100, 100), position=(0, 0, 0), lakes=2, depth=4, trees=None, noise=None, tile=512):
+    """ All generation parameters, defaults filled in, json friendly. trees:
+        number of trees drawn, None for a random number up to size / 100.
+        noise: noise.heightmap parameters (scale, octaves, warp, height...)
+        for a coherent noise heightmap, None for white noise. tile: side of
+        the square tiles generated as separate jobs """
+    return dict(size=[int(n) for n in size], position=[float(p) for p in position],
+                lakes=int(lakes), depth=float(depth), trees=None if trees is None else int(trees),
+                noise=None if noise is None else dict(sorted(noise.items())), tile=int(tile))
+
+
+def tiles(shape, tile):
+    """ (i0, i1, j0, j1) bounds of the tile x tile blocks covering shape """
+    return [(i, min(i + tile, shape[0]), j, min(j + tile, shape[1]))
+            for i in range(0, shape[0], tile) for j in range(0, shape[1], tile)]
+
+
+def _run_tile_job(job, shared, *args):
+    """ job(*arrays, *args) in a worker, arrays attached from shared memory
+        blocks given as (name, shape, dtype) """
+    blocks = [SharedMemory(name) for name, _, _ in shared]
+    arrays = [np.ndarray(shape, dtype, block.buf) for block, (_, shape, dtype) in zip(blocks, shared)]
+    try:
+        return job(*arrays, *args)
+    finally:
+        del arrays  # views of the blocks, to release before closing them
+        for block in blocks:
+            block.close()
+
+
+class TilePool:
+    """ Runs tile jobs on numpy arrays, in this process with 1 worker, else in
+        a process pool: the arrays then live in shared memory, workers write
+        their blocks in place and only job arguments and results are pickled.
+        Arrays made by array or share are views of the shared memory, freed
+        when the pool is closed: copy what has to outlive it. Workers are
+        started by a fork server (spawned where there is none), never forked
+        from this process: it may hold a GL context and texture decoding
+        threads. Jobs only need this module, noise and geometry, no OpenGL """
+
+    def __init__(self, workers=1):
+        self.executor = None
+        if workers > 1:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+        self.blocks = []  # (array, SharedMemory) pairs
+
+    def array(self, shape, dtype):
+        """ Uninitialized array that jobs can fill """
+        if self.executor is None:
+            return np.empty(shape, dtype)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        block = SharedMemory(create=True, size=max(size, 1))
+        array = np.ndarray(shape, dtype, block.buf)
+        self.blocks.append((array, block))
+        return array
+
+    def share(self, array):
+        """ Array with the content of array, that jobs can read """
+        if self.executor is None:
+            return array
+        shared = self.array(array.shape, array.dtype)
+        shared[...] = array
+        return shared
+
+    def map(self, job, arrays, args):
+        """ [job(*arrays, *job_args) for job_args in args], arrays being made
+            by this pool, in parallel when there are workers """
+        args = list(args)
+        if self.executor is None:
+            return [job(*arrays, *job_args) for job_args in args]
+        shared = [next((block.name, array.shape, array.dtype.str) for view, block in self.blocks if view is array)
+                  for array in arrays]
+        return list(self.executor.map(_run_tile_job, repeat(job, len(args)), repeat(shared, len(args)),
+                                      *zip(*args)))
+
+    def close(self):
+        """ Stops the workers and frees the shared memory """
+        if self.executor is not None:
+            self.executor.shutdown()
+        blocks, self.blocks = [block for _, block in self.blocks], []
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def tile_heightmap(heightmap, bounds, seed, relief):
+    """ Noise heights of the block bounds of heightmap """
+    (i0, i1, j0, j1) = bounds
+    heightmap[i0:i1, j0:j1] = noise.heightmap((i1 - i0, j1 - j0), (i0, j0), seed=seed, **relief)
+
+
+def tile_normals(heightmap, normals, bounds, position, height_scale):
+    """ Normals of the block bounds of the terrain, computed on the block grown
+        by one vertex on every side: border vertices get all their triangles,
+        and the same normals as a whole terrain computation """
+    (i0, i1, j0, j1) = bounds
+    (h0, h1) = (max(i0 - 1, 0), min(i1 + 1, heightmap.shape[0]))
+    (k0, k1) = (max(j0 - 1, 0), min(j1 + 1, heightmap.shape[1]))
+    (vertices, _, index) = gridMesh(heightmap[h0:h1, k0:k1], height_scale, position,
+                                    (h0, k0), heightmap.shape)
+    grown = calcNormals(vertices, index)[0].reshape(h1 - h0, k1 - k0, 3)
+    normals[i0:i1, j0:j1] = grown[i0 - h0:i1 - h0, j0 - k0:j1 - k0]
+
+
+def tile_trees(heightmap, water, bounds, position, height_scale, count, rng):
+    """ Positions of count trees on the grass of the block bounds """
+    (i0, i1, j0, j1) = bounds
+    vertices = gridMesh(heightmap[i0:i1, j0:j1], height_scale, position, (i0, j0), heightmap.shape)[0]
+    return treePositions(vertices, np.flatnonzero(~water[i0:i1, j0:j1]), count, rng)
+
+
+def generate_world(seed, workers=None, **params):
+    """ World of this seed and world_params: heightmap, lakes dug in it,
+        normals, then trees on the grass out of the volcano square. Tiles are
+        run by 'workers' processes, None for one per cpu when there are
+        several tiles; the world is the same for any number of workers """
+    from textures import Lake, LakeTerrain  # GL classes, main process only
+    world = World(seed, world_params(**params))
+    (size, position, lakes, depth, trees, relief, tile) = (
+        world.params[name] for name in ('size', 'position', 'lakes', 'depth', 'trees', 'noise', 'tile'))
+    blocks = tiles(size, tile)
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(blocks))
+
+    with TilePool(workers) as pool:
+        if relief is None:
+            heightmap = pool.share(world.rng('heightmap').random(size))
+        else:
+            heightmap = pool.array(size, np.float32)
+            noise_seed = int(world.rng('heightmap').integers(2 ** 31))
+            pool.map(tile_heightmap, [heightmap], [(bounds, noise_seed, relief) for bounds in blocks])
+
+        rng = world.rng('lakes')
+        dug = [Lake(None, size, None, None, depth=depth, rng=rng) for _ in range(lakes)]
+        for lake in dug:
+            lake.dig(heightmap)
+        world.water = waterMask(heightmap.shape, dug)
+        world.lakes = np.array([lake.extremums for lake in dug], np.float32).reshape(-1, 4)
+
+        normals = pool.array(tuple(size) + (3,), np.float32)
+        pool.map(tile_normals, [heightmap, normals], [(bounds, position, LakeTerrain.height_scale) for bounds in blocks])
+
+        # tree count split among tiles in proportion of their grass
+        rng = world.rng('trees')
+        count = rng.integers(0, size[0] * size[1] // 100 + 1) if trees is None else trees
+        grass = np.array([np.count_nonzero(~world.water[i0:i1, j0:j1]) for (i0, i1, j0, j1) in blocks])
+        counts = rng.multinomial(count, grass / max(grass.sum(), 1))
+        positions = pool.map(tile_trees, [heightmap, pool.share(world.water)],
+                             zip(blocks, repeat(position), repeat(LakeTerrain.height_scale), counts, world.tile_rngs('trees', len(blocks))))
+        world.trees = np.concatenate(positions).reshape(-1, 3)
+
+        # out of the shared memory before the pool frees it
+        (world.heightmap, world.normals) = (np.array(heightmap), np.array(normals))
+        del heightmap, normals
+    return world
+
+
+def world_cache_file(seed, params):
+    """ Cache file name of the world of seed and complete params """
+    key = repr((WORLD_VERSION, seed, sorted(params.items())))
+    return os.path.join(WORLD_CACHE_DIR, '%s.npz' % hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def load_world(seed, use_cache=True, workers=None, **params):
+    """ generate_world(seed, workers, **params), read from the on-disk cache
+        when this seed and parameters were generated before, else written to it """
+    cache_file = world_cache_file(seed, world_params(**params))
+    if use_cache and os.path.exists(cache_file):
+        try:
+            return World.load(cache_file)
+        except (OSError, ValueError, KeyError) as exception:
+            print('WARNING: ignoring broken cache', cache_file, exception)
+    world = generate_world(seed, workers, **params)
+    if use_cache:
+        world.save(cache_file)
+    return world